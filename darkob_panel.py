@@ -5,23 +5,57 @@ Darkob — Live User Activity Panel (High-Performance Edition)
 
 وابستگی‌ها:
   pip install fastapi uvicorn
+اختیاری:
+  pip install orjson         # سریال‌سازی سریع‌تر JSON برای SSE و APIها
+  pip install asyncinotify   # tail بدون polling روی لینوکس
+  pip install uvloop httptools   # uvicorn در صورت نصب خودکار از این‌ها استفاده می‌کند
+
+اجرا:
+  python darkob_panel.py --port 8888
+  # یا مستقیم با uvicorn:
+  uvicorn darkob_panel:app --loop uvloop --http httptools --backlog 4096 --workers 1
+  حتماً یک worker: AGG و مشترک‌های SSE در حافظه‌ی همین پردازه‌اند
+  (برای full-scan از FULL_SCAN_WORKERS استفاده کنید، نه --workers).
 """
 
 import argparse
 import asyncio
+import atexit
+import hashlib
+import heapq
 import json
 import logging
+import mmap
+import multiprocessing
 import os
+import queue
 import re
-from collections import deque
-from typing import AsyncGenerator, Deque, Dict, List, Optional, Set, Tuple
+import sys
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
+from operator import itemgetter
+from typing import AsyncGenerator, Deque, Dict, List, Optional, Set, Tuple, Union
 
 from fastapi import FastAPI, Query, Request
+
+try:  # اختیاری: سریال‌سازی سریع‌تر JSON
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+try:  # اختیاری: بیدار شدن با inotify به‌جای polling (فقط لینوکس)
+    from asyncinotify import Inotify, Mask
+except ImportError:  # pragma: no cover
+    Inotify = None  # type: ignore
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import (
     HTMLResponse,
     JSONResponse,
     PlainTextResponse,
+    Response,
     StreamingResponse,
 )
 
@@ -30,6 +64,7 @@ from fastapi.responses import (
 # -----------------------------
 LOG_PATH = os.getenv("LOG_PATH", "/root/V2IpLimit/connections_log.txt")
 USER_STATS_FILE = os.getenv("USER_STATS_FILE", "/root/V2IpLimit/user_stats.json")
+USER_TAIL_FILE = os.getenv("USER_TAIL_FILE", "/root/V2IpLimit/darkob_user_tail.json")
 
 # تعداد رخدادهایی که فقط برای "سرویس‌دهی سریع" و "LIVE" در حافظه نگه می‌داریم
 MAX_RECENT_EVENTS = int(os.getenv("MAX_RECENT_EVENTS", "5000"))
@@ -37,13 +72,47 @@ MAX_RECENT_EVENTS = int(os.getenv("MAX_RECENT_EVENTS", "5000"))
 # حداکثر تعداد hostهای نمونه که برای جست‌وجوی سایت برای هر کاربر ذخیره می‌کنیم
 MAX_HOSTS_PER_USER = int(os.getenv("MAX_HOSTS_PER_USER", "200"))
 
+# حداکثر تعداد نام‌های کامل (variant) که برای هر base نگه می‌داریم
+MAX_VARIANTS_PER_USER = int(os.getenv("MAX_VARIANTS_PER_USER", "64"))
+
+# تعداد رخدادهای اخیر هر base که برای /api/user_events در حافظه نگه می‌داریم
+USER_TAIL_MAX = int(os.getenv("USER_TAIL_MAX", "5000"))
+# سقف کل رخدادهای USER_TAIL (همه‌ی baseها با هم)
+USER_TAIL_MAX_EVENTS = int(os.getenv("USER_TAIL_MAX_EVENTS", "300000"))
+# هر چند ثانیه USER_TAIL روی دیسک ذخیره شود؛ خطوط بعد از آخرین ذخیره هنگام شروع از خود لاگ replay می‌شوند
+USER_TAIL_PERSIST_SEC = float(os.getenv("USER_TAIL_PERSIST_SEC", "600"))
+# سریال‌سازی USER_TAIL هر این‌قدر ثانیه یک‌بار به event loop فرصت می‌دهد
+USER_TAIL_PERSIST_SLICE_SEC = float(os.getenv("USER_TAIL_PERSIST_SLICE_SEC", "0.01"))
+
+# tail: با inotify فقط روی تغییر فایل بیدار می‌شویم؛ این مهلت فقط محض احتیاط است
+TAIL_USE_INOTIFY = Inotify is not None and sys.platform == "linux"
+TAIL_INOTIFY_TIMEOUT_SEC = float(os.getenv("TAIL_INOTIFY_TIMEOUT_SEC", "5"))
+TAIL_POLL_SEC = 0.2
+
 # فاصله‌ی heartbeat برای SSE
 SSE_HEARTBEAT_SEC = 15
 
+# snapshot کاربران برای /api/users در پس‌زمینه ساخته می‌شود
+USERS_DEFAULT_LIMIT = 600    # همان limit که UI می‌فرستد
+SNAPSHOT_REFRESH_SEC = float(os.getenv("SNAPSHOT_REFRESH_SEC", "0.5"))
+SNAPSHOT_CHECK_SEC = 0.1
+SNAPSHOT_GROWTH_TRIGGER = int(os.getenv("SNAPSHOT_GROWTH_TRIGGER", "50"))  # base جدید → ساخت زودتر
+
+# سقف صف هر مشترک SSE؛ در صورت پر شدن، قدیمی‌ترین پیام حذف می‌شود
+SSE_QUEUE_MAXSIZE = int(os.getenv("SSE_QUEUE_MAXSIZE", "1024"))
+
+# رخدادهای live در یک frame تجمیع می‌شوند: حداکثر این مدت صبر یا این تعداد رخداد
+SSE_BATCH_MS = int(os.getenv("SSE_BATCH_MS", "25"))
+SSE_BATCH_MAX = int(os.getenv("SSE_BATCH_MAX", "64"))
+
 # --- Full Scan Throttling ---
-FULL_SCAN_SLEEP_EVERY = int(os.getenv("FULL_SCAN_SLEEP_EVERY", "3000"))  # هر چند خط یک مکث
-FULL_SCAN_SLEEP_SEC   = float(os.getenv("FULL_SCAN_SLEEP_SEC", "0.005")) # مدت مکث
+FULL_SCAN_CHUNK_BYTES = int(os.getenv("FULL_SCAN_CHUNK_BYTES", str(4 << 20)))  # اندازه‌ی هر تکه؛ بین تکه‌ها به event loop برمی‌گردیم
 FULL_SCAN_LOG_CHUNK   = int(os.getenv("FULL_SCAN_LOG_CHUNK", "100000"))  # هر چند خط یک لاگِ پیشرفت
+# اسکن موازی با چند پردازه؛ فقط برای فایل‌های بزرگ‌تر از این اندازه
+FULL_SCAN_WORKERS = int(os.getenv("FULL_SCAN_WORKERS", str(os.cpu_count() or 1)))
+FULL_SCAN_PARALLEL_MIN_BYTES = int(os.getenv("FULL_SCAN_PARALLEL_MIN_BYTES", str(64 << 20)))
+# اندازه‌ی تقریبی هر بازه‌ی کاری؛ بازه‌های بیشتر از workerها یعنی تقسیم بار بهتر و پیشرفت ریزتر
+FULL_SCAN_RANGE_BYTES = int(os.getenv("FULL_SCAN_RANGE_BYTES", str(32 << 20)))
 
 # پیشرفت اسکن (برای UI)
 FULL_SCAN_TOTAL_BYTES: int = 0
@@ -58,81 +127,326 @@ FULL_SCAN_ERR: Optional[str] = None
 # -----------------------------
 # لاگینگ
 # -----------------------------
+# نوشتن واقعی روی stderr در یک thread جدا (QueueListener) انجام می‌شود تا
+# logger.info داخل coroutineها event loop را روی I/O معطل نکند.
 logger = logging.getLogger("darkob")
 handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s"))
-logger.addHandler(handler)
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
 logger.setLevel(logging.INFO)
+_log_listener = QueueListener(_log_queue, handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # flush پیام‌های باقی‌مانده هنگام خروج
 
 # -----------------------------
 # پارس لاگ
 # -----------------------------
 # "YYYY-MM-DD HH:MM:SS | email | host"
-RE_MATCHED = re.compile(
-    r"^\s*(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\s*\|\s*([^|]+?)\s*\|\s*(.+)\s*$"
-)
+# رخداد پارس‌شده: (ts, user, host)
+Event = Tuple[str, str, str]
+# خلاصه‌ی جزئی هر base (قابل pickle، بدون id های intern):
+#   [count, last_ts, last_ts_int, sample_host, variants:set[str], hosts:set[str]]
+Partial = Dict[str, list]
+
+# فقط timestamp (۱۹ کاراکتر) با regex لنگرشده چک می‌شود؛ جدا کردن فیلدها با split
+RE_TS = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\Z")
+_ts_match = RE_TS.match
 
-def parse_line(line: str) -> Optional[Dict[str, str]]:
-    m = RE_MATCHED.match(line)
-    if not m:
+# hostهایی که در UI اولویت نمایش دارند؛ یک regex از پیش کامپایل‌شده به‌جای چند in
+PORN_KEYWORDS = ("porn",)
+RE_PORN = re.compile("|".join(map(re.escape, PORN_KEYWORDS)), re.IGNORECASE)
+
+def parse_line(line: str) -> Optional[Event]:
+    """
+    پارس یک خط: فیلدها با یک split در C جدا می‌شوند (host خودش ممکن است '|' داشته باشد)
+    و فقط timestamp با الگوی کوچکِ RE_TS اعتبارسنجی می‌شود.
+    """
+    parts = line.split("|", 2)
+    if len(parts) != 3:
         return None
-    ts, user, host = m.group(1), m.group(2).strip(), m.group(3).strip()
-    if not user:
+    ts = parts[0].strip()
+    if _ts_match(ts) is None:
         return None
-    return {"ts": ts, "user": user, "host": host or "UNKNOWN"}
+    user = parts[1].strip()
+    host = parts[2].strip()
+    # مثل الگوی قدیمی RE_MATCHED، خطِ بدون user یا host رد می‌شود
+    if not user or not host:
+        return None
+    return (ts, user, host)
+
+_TS_DIGITS = str.maketrans("", "", "-: ")
+
+def pack_ts(ts: str) -> int:
+    """"YYYY-MM-DD HH:MM:SS" -> عدد YYYYMMDDHHMMSS (ترتیب عددی = ترتیب زمانی)."""
+    return int(ts.translate(_TS_DIGITS))
+
+def parse_lines(buf: bytes) -> List[Event]:
+    """
+    پارس گروهی یک بافر چندخطی (یک‌بار decode برای کل بافر).
+    منطق parse_line این‌جا inline شده تا هزینه‌ی صدا زدن تابع برای هر خط حذف شود.
+    """
+    out: List[Event] = []
+    append = out.append
+    ts_match = _ts_match
+    for line in buf.decode("utf-8", errors="ignore").split("\n"):
+        parts = line.split("|", 2)
+        if len(parts) != 3:
+            continue
+        ts = parts[0].strip()
+        if ts_match(ts) is None:
+            continue
+        user = parts[1].strip()
+        host = parts[2].strip()
+        if user and host:
+            append((ts, user, host))
+    return out
+
+# کش نتیجه‌ی base_user: نام‌های کاربری بسیار تکراری‌اند. مقدار، خودِ نام را هم نگه می‌دارد
+# تا همه‌ی رخدادهای یک نام (مثلاً در USER_TAIL) یک رشته‌ی مشترک داشته باشند.
+BASE_CACHE_MAX = int(os.getenv("BASE_CACHE_MAX", "100000"))
+_BASE_CACHE: Dict[str, Tuple[str, str]] = {}
+
+def user_and_base(u: str) -> Tuple[str, str]:
+    """(نسخه‌ی مشترک u از کش، base آن)."""
+    r = _BASE_CACHE.get(u)
+    if r is not None:
+        return r
+    b = u
+    if u:
+        i = u.find(".")
+        if i > 0 and u[:i].isdigit():
+            b = u[i + 1 :]
+    if len(_BASE_CACHE) >= BASE_CACHE_MAX:
+        # نیمه‌ی قدیمی‌تر (به ترتیب درج) را دور بریز
+        for k in list(islice(_BASE_CACHE, len(_BASE_CACHE) // 2)):
+            del _BASE_CACHE[k]
+    r = _BASE_CACHE[u] = (u, b)
+    return r
 
 def base_user(u: str) -> str:
     """برگرداندن base: حذف پیشوند عددی قبل از اولین نقطه (5823.mohammad -> mohammad)."""
-    if not u:
-        return u
-    i = u.find(".")
-    if i > 0:
-        left, right = u[:i], u[i + 1 :]
-        if left.isdigit():
-            return right
-    return u
+    return user_and_base(u)[1]
 
 # -----------------------------
 # وضعیت حافظه‌ای
 # -----------------------------
 # رخدادهای اخیر (فقط برای live و عیب‌یابی‌های سبک)
-recent_events: Deque[Dict[str, str]] = deque(maxlen=MAX_RECENT_EVENTS)
+class RecentRing:
+    """
+    بافر حلقوی با اندازه‌ی ثابت برای رخدادهای اخیر؛ هر فیلد در لیست جداگانه
+    (ستونی) نگه داشته می‌شود و tuple فقط هنگام خواندن ساخته می‌شود.
+    """
+
+    def __init__(self, n: int) -> None:
+        self.size = n
+        self.ts: List[Optional[str]] = [None] * n
+        self.user: List[Optional[str]] = [None] * n
+        self.host: List[Optional[str]] = [None] * n
+        self.idx = 0   # خانه‌ی بعدی برای نوشتن
+        self.n = 0     # تعداد خانه‌های پر
+
+    def append(self, ts: str, user: str, host: str) -> None:
+        i = self.idx
+        self.ts[i] = ts
+        self.user[i] = user
+        self.host[i] = host
+        self.idx = (i + 1) % self.size
+        if self.n < self.size:
+            self.n += 1
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __iter__(self):
+        """از قدیمی‌ترین به جدیدترین."""
+        start = (self.idx - self.n) % self.size
+        for k in range(self.n):
+            i = (start + k) % self.size
+            yield (self.ts[i], self.user[i], self.host[i])
+
+recent_events = RecentRing(MAX_RECENT_EVENTS)
+
+# رخدادهای اخیر هر base به ترتیب زمان (فقط از مسیر tail، پس پیوسته تا انتهای فایل)؛
+# ترتیب کلیدها ترتیب آخرین رخداد است تا با رسیدن به USER_TAIL_MAX_EVENTS کم‌کارترین base برود
+USER_TAIL: "OrderedDict[str, Deque[Event]]" = OrderedDict()
+USER_TAIL_EVENTS = 0  # مجموع طول همه‌ی dequeها
+# baseهایی که deque‌شان از حافظه بیرون رفته؛ دیگر از USER_TAIL_FROM کامل نیستند
+USER_TAIL_EVICTED: Set[str] = set()
+# آیا USER_TAIL از آخرین ذخیره‌ی موفق عوض شده؛ اگر نه، ذخیره‌ی دوره‌ای رد می‌شود
+USER_TAIL_DIRTY = False
+# inode فایلی که آخرین ذخیره‌ی موفق برایش بوده (None یعنی روی دیسک چیزی معتبر نداریم)
+_USER_TAIL_SAVED_INODE: Optional[int] = None
+# offset فایل فعلی که از آن به بعد همه‌ی رخدادها در USER_TAIL آمده‌اند (شروع tail پیوسته)؛
+# dequeی که هنوز به maxlen نرسیده یعنی هیچ رخدادی از آن base بعد از این offset جا نمانده،
+# پس صفحه‌ی کاربر از حافظه شروع و از همین offset در فایل ادامه پیدا می‌کند. None: نامعلوم
+USER_TAIL_FROM: Optional[int] = None
 
 # شاخص کاربران: base -> aggregate
 # aggregate: {
 #   "count": int,
 #   "last_ts": str,
-#   "sample_host": str|None,
-#   "variants": set(full-names),
-#   "hosts": set(sample-of-hosts up to MAX_HOSTS_PER_USER)
+#   "last_ts_int": int (pack_ts(last_ts)، برای مقایسه),
+#   "sample_host": str (host جدیدترین رخداد؛ intern نمی‌شود),
+#   "porn_host": Optional[int] (اولین host پورن در hosts؛ اولویت نمایش، یک‌بار هنگام ورود),
+#   "variants": set(full-names up to MAX_VARIANTS_PER_USER),
+#   "hosts": set(host ids, sample up to MAX_HOSTS_PER_USER),
+#   "base_lc": str, "variants_lc": set(str)  (نسخه‌ی lowercase برای جست‌وجو)
 # }
 AGG: Dict[str, Dict[str, object]] = {}
+# baseهایی که از آخرین ساخت AGG_VIEW تغییر کرده‌اند (فقط همین‌ها دوباره ساخته می‌شوند)
+AGG_DIRTY: Set[str] = set()
+
+# جدول intern برای hostها: هر host یک‌بار ذخیره می‌شود و AGG فقط id نگه می‌دارد.
+# فقط hostهایی intern می‌شوند که واقعاً وارد "hosts" یک base می‌شوند، پس اندازه‌ی جدول
+# با مجموع همان setهای سقف‌دار محدود است، نه با تعداد hostهای یکتای دیده‌شده.
+HOST_INTERN: Dict[str, int] = {}
+HOST_STR: List[str] = []
+HOST_LC: List[str] = []  # موازی HOST_STR؛ lower() هر host فقط یک‌بار
+HOST_PORN: List[bool] = []  # موازی HOST_STR؛ تطبیق RE_PORN هم فقط یک‌بار برای هر host
+
+def intern_host(h: str) -> int:
+    i = HOST_INTERN.get(h)
+    if i is None:
+        i = len(HOST_STR)
+        HOST_INTERN[h] = i
+        HOST_STR.append(h)
+        HOST_LC.append(h.lower())
+        HOST_PORN.append(RE_PORN.search(h) is not None)
+    return i
+
+def shared_host(h: str) -> str:
+    """اگر h قبلاً intern شده، همان رشته‌ی جدول؛ وگرنه خودش (جدول بزرگ نمی‌شود)."""
+    i = HOST_INTERN.get(h)
+    return h if i is None else HOST_STR[i]
+
+def json_bytes(obj: object) -> bytes:
+    """JSON فشرده‌ی UTF-8؛ با orjson اگر نصب باشد (مستقیماً bytes برمی‌گرداند)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def sse_frame(msg: object) -> bytes:
+    """frame کامل SSE برای یک پیام."""
+    return b"event: message\ndata: " + json_bytes(msg) + b"\n\n"
+
+class JSONBytesResponse(JSONResponse):
+    """JSONResponse با همان json_bytes (orjson اگر نصب باشد، وگرنه json فشرده)."""
+    def render(self, content: object) -> bytes:
+        return json_bytes(content)
+
+def etag_of(body: bytes) -> str:
+    """ETag قوی برای بدنه‌ی آماده (blake2b هشت‌بایتی)."""
+    return '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    مقایسه‌ی ضعیف If-None-Match (RFC 9110): هدر می‌تواند فهرستی با ',' باشد و
+    proxyها گاهی W/ جلوی tag می‌گذارند؛ هر دو سمت بدون W/ مقایسه می‌شوند.
+    """
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag[2:] if etag.startswith("W/") else etag
+    for t in if_none_match.split(","):
+        t = t.strip()
+        if t.startswith("W/"):
+            t = t[2:]
+        if t == etag:
+            return True
+    return False
+
+def etag_response(request: Request, body: bytes, etag: Optional[str] = None) -> Response:
+    """
+    پاسخ JSON با ETag؛ اگر If-None-Match کلاینت همین نسخه باشد فقط 304 بدون بدنه.
+    etag آماده (مثلاً برای snapshot) را می‌شود داد تا هر درخواست دوباره hash نشود.
+    """
+    etag = etag or etag_of(body)
+    inm = request.headers.get("if-none-match")
+    if inm and etag_matches(inm, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
 
 class Broadcaster:
-    def __init__(self) -> None:
+    def __init__(self, maxsize: int = 1024) -> None:
         self.subscribers: Set[asyncio.Queue] = set()
+        self.maxsize = maxsize
+        # تعداد پیام‌های دورریخته‌شده برای هر مشترک کُند
+        self.dropped: Dict[asyncio.Queue, int] = {}
+        # رخدادهای منتظرِ تجمیع؛ _broadcaster_flusher آن را می‌سازد و دسته‌ای پخش می‌کند
+        self.pending: Optional[asyncio.Queue] = None
 
     def subscribe(self) -> asyncio.Queue:
-        q: asyncio.Queue = asyncio.Queue()
+        q: asyncio.Queue = asyncio.Queue(maxsize=self.maxsize)
         self.subscribers.add(q)
+        self.dropped[q] = 0
         return q
 
     def unsubscribe(self, q: asyncio.Queue) -> None:
         self.subscribers.discard(q)
-
-    async def broadcast(self, msg: Dict[str, str]) -> None:
+        self.dropped.pop(q, None)
+
+    def publish(self, ev: Tuple[str, str, str, str, int]) -> None:
+        """
+        یک رخداد برای پخش دسته‌ای؛ اگر مشترکی نباشد دور ریخته می‌شود.
+        ev همان ردیفی است که در frame می‌رود، به ترتیب (ts, user, base, host, ts_int)؛
+        ts_int همان pack_ts(ts) است تا UI به‌جای مقایسه‌ی رشته، عدد مقایسه کند.
+        handleFrame در worker و liveRow در UI همین ترتیب را می‌خوانند؛ هر تغییری باید هر سه را عوض کند.
+        """
+        if self.subscribers and self.pending is not None:
+            self.pending.put_nowait(ev)
+
+    async def broadcast(self, msg: Union[Dict[str, object], bytes]) -> None:
+        """
+        پیام یک‌بار (همین‌جا) به frame کامل SSE تبدیل می‌شود و همان bytes
+        برای همه‌ی مشترک‌ها صف می‌شود.
+        """
         if not self.subscribers:
             return
+        frame = msg if isinstance(msg, bytes) else sse_frame(msg)
         dead = []
         for q in list(self.subscribers):
             try:
-                q.put_nowait(msg)  # non-blocking
+                q.put_nowait(frame)  # non-blocking
+            except asyncio.QueueFull:
+                # مشترک کُند: قدیمی‌ترین پیام را دور بریز تا حافظه بی‌حد رشد نکند
+                try:
+                    q.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+                q.put_nowait(frame)
+                self.dropped[q] = self.dropped.get(q, 0) + 1
             except Exception:
                 dead.append(q)
         for q in dead:
             self.unsubscribe(q)
 
-broadcaster = Broadcaster()
+broadcaster = Broadcaster(maxsize=SSE_QUEUE_MAXSIZE)
+
+async def _broadcaster_flusher() -> None:
+    """
+    رخدادهای publish‌شده را جمع می‌کند و هر SSE_BATCH_MS میلی‌ثانیه
+    (یا با رسیدن به SSE_BATCH_MAX رخداد) یک frame به شکل {"rows": [[...], ...]} پخش می‌کند.
+    هر ردیف آرایه‌ای به ترتیب Broadcaster.publish است (بدون تکرار نام کلیدها در هر رخداد).
+    """
+    loop = asyncio.get_running_loop()
+    window = SSE_BATCH_MS / 1000.0
+    pending: asyncio.Queue = asyncio.Queue()
+    broadcaster.pending = pending
+    while True:
+        batch = [await pending.get()]
+        deadline = loop.time() + window
+        while len(batch) < SSE_BATCH_MAX:
+            if not pending.empty():
+                batch.append(pending.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(pending.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        await broadcaster.broadcast({"rows": batch})
 
 # -----------------------------
 # بارگذاری اولیه + دنبال‌کردن فایل
@@ -143,11 +457,12 @@ async def initial_index(path: str, scan_tail_lines: int = 50000) -> None:
     تا UI از ابتدا اطلاعات داشته باشد؛ ولی همه‌ی تاریخچه را در حافظه نمی‌ریزیم.
     """
     try:
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            lines = f.readlines()[-scan_tail_lines:]
+        # فقط همان N خط آخر را از انتهای فایل می‌خوانیم (نه کل فایل)
+        lines = [ln for _, ln in islice(_iter_file_backward(path), scan_tail_lines)]
+        lines.reverse()
         init = 0
         for ln in lines:
-            ev = parse_line(ln.rstrip("\n"))
+            ev = parse_line(ln.decode("utf-8", errors="ignore"))
             if ev:
                 _apply_event_to_agg(ev)
                 init += 1
@@ -158,10 +473,47 @@ async def initial_index(path: str, scan_tail_lines: int = 50000) -> None:
         logger.exception(f"[initial_index] error: {e}")
 
 
+def _iter_chunks(mm: mmap.mmap, start: int, end: int):
+    """تکه‌های [start, end) با اندازه‌ی حدود FULL_SCAN_CHUNK_BYTES که روی '\n' تمام می‌شوند."""
+    while start < end:
+        stop = min(start + FULL_SCAN_CHUNK_BYTES, end)
+        if stop < end:
+            nl = mm.rfind(b"\n", start, stop)
+            if nl >= 0:
+                stop = nl + 1     # تکه روی مرز خط تمام شود
+        yield stop, mm[start:stop]
+        start = stop
+
+def _split_ranges(mm: mmap.mmap, size: int, n: int) -> List[Tuple[int, int]]:
+    """تقسیم [0, size) به n بازه که مرزهایشان بعد از '\n' است."""
+    bounds = [0]
+    for i in range(1, n):
+        nl = mm.find(b"\n", max(size * i // n, bounds[-1]))
+        pos = size if nl < 0 else nl + 1
+        if pos >= size:
+            break
+        bounds.append(pos)
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+def _scan_range(path: str, start: int, end: int) -> Tuple[Partial, int, int]:
+    """اجرا در worker: پارس بازه‌ی [start, end)؛ خلاصه‌ی جزئی، تعداد رخدادها و بایت‌های خوانده‌شده."""
+    acc: Partial = {}
+    applied = 0
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as mm:
+        for _, chunk in _iter_chunks(mm, start, end):
+            evs = parse_lines(chunk)
+            _fold_events(evs, acc)
+            applied += len(evs)
+    return acc, applied, end - start
+
 async def full_scan_file(path: str) -> None:
     """
-    کل فایل را از 0 تا اندازه‌ای که در لحظه‌ی شروع وجود دارد، آهسته می‌خواند
-    و روی AGG اعمال می‌کند. هر چند خط مکث کوتاه تا فشار نیفتد.
+    کل فایل را از 0 تا اندازه‌ای که در لحظه‌ی شروع وجود دارد با mmap می‌خواند
+    و روی AGG اعمال می‌کند. فایل‌های بزرگ به بازه‌هایی حدوداً FULL_SCAN_RANGE_BYTES
+    تقسیم و بین FULL_SCAN_WORKERS پردازه پخش می‌شوند (هر بازه یک خلاصه‌ی جزئی
+    برمی‌گرداند که این‌جا ادغام می‌شود و پیشرفت را جلو می‌برد)؛
+    فایل‌های کوچک همین‌جا تکه‌به‌تکه، با برگشت به event loop بین تکه‌ها.
     خطوطی که بعد از شروع اسکن اضافه می‌شوند را عمداً نمی‌خوانیم
     تا با tail_file دوباره‌شماری نشود.
     """
@@ -179,32 +531,54 @@ async def full_scan_file(path: str) -> None:
         applied = 0
         last_logged = 0
 
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            while True:
-                pos_before = f.tell()
-                if pos_before >= stop_offset:
-                    break  # به اندازه‌ی تعیین‌شده رسیدیم؛ ادامه نمی‌دهیم
-
-                line = f.readline()
-                if not line:
-                    # فایل کوتاه‌تر از stop_offset بوده ولی فعلاً داده‌ای نیست؛ کمی صبر کن
-                    await asyncio.sleep(0.05)
-                    continue
-
-                FULL_SCAN_READ_BYTES = min(pos_before, stop_offset)
-
-                ev = parse_line(line.rstrip("\n"))
-                if ev:
-                    _apply_event_to_agg(ev)
-                    applied += 1
-                    if applied % FULL_SCAN_SLEEP_EVERY == 0:
-                        await asyncio.sleep(FULL_SCAN_SLEEP_SEC)
-
-                if applied - last_logged >= FULL_SCAN_LOG_CHUNK:
-                    last_logged = applied
-                    logger.info(
-                        f"[full-scan] applied: {applied}, progress: {FULL_SCAN_READ_BYTES}/{FULL_SCAN_TOTAL_BYTES} bytes"
-                    )
+        if stop_offset > 0:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), stop_offset, access=mmap.ACCESS_READ) as mm:
+                if FULL_SCAN_WORKERS > 1 and stop_offset >= FULL_SCAN_PARALLEL_MIN_BYTES:
+                    n_ranges = max(FULL_SCAN_WORKERS, -(-stop_offset // FULL_SCAN_RANGE_BYTES))
+                    ranges = _split_ranges(mm, stop_offset, n_ranges)
+                else:
+                    ranges = None
+                    for end, chunk in _iter_chunks(mm, 0, stop_offset):
+                        evs = parse_lines(chunk)
+                        _apply_events_to_agg_bulk(evs)
+                        applied += len(evs)
+                        FULL_SCAN_READ_BYTES = end
+
+                        if applied - last_logged >= FULL_SCAN_LOG_CHUNK:
+                            last_logged = applied
+                            logger.info(
+                                f"[full-scan] applied: {applied}, progress: {FULL_SCAN_READ_BYTES}/{FULL_SCAN_TOTAL_BYTES} bytes"
+                            )
+                        await asyncio.sleep(0)
+
+            if ranges:
+                logger.info(f"[full-scan] parallel: {len(ranges)} ranges on {FULL_SCAN_WORKERS} workers")
+                loop = asyncio.get_running_loop()
+                ctx = multiprocessing.get_context("spawn")
+                # بدون with: shutdown(wait=True) در __exit__ تا تمام شدن بازه‌های باقی‌مانده
+                # event loop را بلوکه می‌کرد (مثلاً بعد از خطای یک بازه یا cancel هنگام خاموشی)
+                ex = ProcessPoolExecutor(max_workers=FULL_SCAN_WORKERS, mp_context=ctx)
+                futs: List[asyncio.Future] = []
+                finished = False
+                try:
+                    futs = [loop.run_in_executor(ex, _scan_range, path, start, end) for start, end in ranges]
+                    for fut in asyncio.as_completed(futs):
+                        partial, n, nbytes = await fut
+                        _merge_partial(partial)
+                        applied += n
+                        FULL_SCAN_READ_BYTES = min(FULL_SCAN_READ_BYTES + nbytes, stop_offset)
+                        logger.info(
+                            f"[full-scan] applied: {applied}, progress: {FULL_SCAN_READ_BYTES}/{FULL_SCAN_TOTAL_BYTES} bytes"
+                        )
+                    finished = True
+                finally:
+                    if finished:
+                        # کاری نمانده؛ فقط جمع کردن پردازه‌ها، آن هم خارج از loop
+                        await loop.run_in_executor(None, ex.shutdown)
+                    else:
+                        for fut in futs:
+                            fut.cancel()
+                        ex.shutdown(wait=False, cancel_futures=True)
 
         FULL_SCAN_READ_BYTES = FULL_SCAN_TOTAL_BYTES
         FULL_SCAN_DONE = True
@@ -220,62 +594,233 @@ async def full_scan_file(path: str) -> None:
         logger.exception("[full-scan] error")
 
 
-
-
-
-def _apply_event_to_agg(ev: Dict[str, str]) -> None:
+def _user_tail_add(b: str, ev: Event) -> None:
+    """
+    ev را به deque مربوط به b اضافه و b را جدیدترین base می‌کند. اگر مجموع رخدادها از
+    USER_TAIL_MAX_EVENTS بگذرد، کهنه‌ترین baseها کامل کنار می‌روند (نه از وسط، تا هر
+    deque پسوندی پیوسته از لاگ بماند) و در USER_TAIL_EVICTED علامت می‌خورند.
+    """
+    global USER_TAIL_DIRTY, USER_TAIL_EVENTS
+    dq = USER_TAIL.get(b)
+    if dq is None:
+        dq = USER_TAIL[b] = deque(maxlen=USER_TAIL_MAX)
+    else:
+        USER_TAIL.move_to_end(b)
+    if len(dq) != dq.maxlen:
+        USER_TAIL_EVENTS += 1
+    dq.append(ev)
+    USER_TAIL_DIRTY = True
+    _user_tail_trim()
+
+def _user_tail_trim() -> None:
+    global USER_TAIL_DIRTY, USER_TAIL_EVENTS
+    while USER_TAIL_EVENTS > USER_TAIL_MAX_EVENTS and len(USER_TAIL) > 1:
+        old, dq = USER_TAIL.popitem(last=False)
+        USER_TAIL_EVENTS -= len(dq)
+        USER_TAIL_EVICTED.add(old)
+        USER_TAIL_DIRTY = True
+
+def _user_tail_clear() -> None:
+    global USER_TAIL_EVENTS
+    USER_TAIL.clear()
+    USER_TAIL_EVICTED.clear()
+    USER_TAIL_EVENTS = 0
+
+def _apply_event_to_agg(ev: Event) -> None:
     """به‌روزرسانی شاخص AGG با یک رخداد جدید."""
-    b = base_user(ev["user"])
+    ts, user, host = ev
+    user, b = user_and_base(user)
+    t = pack_ts(ts)
     a = AGG.get(b)
+    # host فقط وقتی intern می‌شود که جایی در "hosts" داشته باشد؛ اگر intern شده باشد
+    # USER_TAIL و sample_host همان رشته‌ی جدول را نگه می‌دارند نه یک نسخه‌ی تازه
+    hid = HOST_INTERN.get(host)
+    if hid is None and (a is None or len(a["hosts"]) < MAX_HOSTS_PER_USER):  # type: ignore
+        hid = intern_host(host)
+    if hid is not None:
+        host = HOST_STR[hid]
+    _user_tail_add(b, (ts, user, host))
     if a is None:
         a = {
             "count": 0,
-            "last_ts": ev["ts"],
-            "sample_host": ev["host"],
-            "variants": set([ev["user"]]),
-            "hosts": set([ev["host"]]) if ev["host"] else set(),
+            "last_ts": ts,
+            "last_ts_int": t,
+            "sample_host": host,
+            "porn_host": None,
+            "variants": set([user]),
+            "hosts": set(),
+            "base_lc": b.lower(),
+            "variants_lc": set([user.lower()]),
         }
         AGG[b] = a
     # update
-    a["count"] = int(a["count"]) + 1
-    if not a.get("last_ts") or str(ev["ts"]) > str(a["last_ts"]):
-        a["last_ts"] = ev["ts"]
+    a["count"] += 1
+    AGG_DIRTY.add(b)
+    if t > a["last_ts_int"]:
+        a["last_ts"] = ts
+        a["last_ts_int"] = t
         # نمونه‌ی host را از جدیدترین رخداد برداریم
-        a["sample_host"] = ev["host"]
+        a["sample_host"] = host
     # نام کامل را اضافه کن
-    a["variants"].add(ev["user"])
+    variants: Set[str] = a["variants"]  # type: ignore
+    if user not in variants and len(variants) < MAX_VARIANTS_PER_USER:
+        variants.add(user)
+        a["variants_lc"].add(user.lower())  # type: ignore
     # می‌توانیم برای جست‌وجوی سایت لیستی نمونه‌ای از hostها نگه داریم
-    hosts: Set[str] = a["hosts"]  # type: ignore
-    if ev["host"] and len(hosts) < MAX_HOSTS_PER_USER:
-        hosts.add(ev["host"])
+    hosts: Set[int] = a["hosts"]  # type: ignore
+    if hid is not None and hid not in hosts and len(hosts) < MAX_HOSTS_PER_USER:
+        hosts.add(hid)
+        if a["porn_host"] is None and HOST_PORN[hid]:
+            a["porn_host"] = hid
+
+def _fold_events(evs: List[Event], acc: Partial) -> Partial:
+    """
+    رخدادها را بر اساس نام کامل گروه‌بندی و در acc (به ازای base) تجمیع می‌کند.
+    کلیدهای همین dict همان variantها هستند؛ پس base_user و variants.add
+    فقط یک‌بار برای هر نام یکتا اجرا می‌شوند، نه برای هر رخداد.
+    در workerهای full-scan هم اجرا می‌شود.
+    """
+    groups: Dict[str, List[Event]] = defaultdict(list)
+    for ev in evs:
+        groups[ev[1]].append(ev)
+
+    for user, group in groups.items():
+        b = base_user(user)
+        # فقط جدیدترینِ هر گروه به عدد تبدیل می‌شود (O(U) نه O(N))
+        newest = max(group, key=itemgetter(0))
+        t = pack_ts(newest[0])
+        p = acc.get(b)
+        if p is None:
+            p = acc[b] = [0, newest[0], t, newest[2], set(), set()]
+        elif t > p[2]:
+            p[1], p[2], p[3] = newest[0], t, newest[2]
+        p[0] += len(group)
+        variants: Set[str] = p[4]
+        if len(variants) < MAX_VARIANTS_PER_USER:
+            variants.add(user)
+        hosts: Set[str] = p[5]
+        if len(hosts) < MAX_HOSTS_PER_USER:
+            for ev in group:
+                hosts.add(ev[2])
+                if len(hosts) >= MAX_HOSTS_PER_USER:
+                    break
+    return acc
+
+def _merge_partial(partial: Partial) -> None:
+    """ادغام خلاصه‌ی جزئی در AGG (همان قواعد _apply_event_to_agg)."""
+    for b, (count, last_ts, t, sample, variants, hosts) in partial.items():
+        a = AGG.get(b)
+        if a is None:
+            a = {
+                "count": 0,
+                "last_ts": last_ts,
+                "last_ts_int": t,
+                "sample_host": sample,
+                "porn_host": None,
+                "variants": set(),
+                "hosts": set(),
+                "base_lc": b.lower(),
+                "variants_lc": set(),
+            }
+            AGG[b] = a
+        elif t > a["last_ts_int"]:
+            a["last_ts"] = last_ts
+            a["last_ts_int"] = t
+            a["sample_host"] = sample
+        a["count"] += count
+        AGG_DIRTY.add(b)
+        av: Set[str] = a["variants"]  # type: ignore
+        if len(av) < MAX_VARIANTS_PER_USER:
+            av_lc: Set[str] = a["variants_lc"]  # type: ignore
+            for v in variants:
+                if v not in av:
+                    av.add(v)
+                    av_lc.add(v.lower())
+                    if len(av) >= MAX_VARIANTS_PER_USER:
+                        break
+        ah: Set[int] = a["hosts"]  # type: ignore
+        if len(ah) < MAX_HOSTS_PER_USER:
+            for h in hosts:
+                hid = intern_host(h)
+                ah.add(hid)
+                if a["porn_host"] is None and HOST_PORN[hid]:
+                    a["porn_host"] = hid
+                if len(ah) >= MAX_HOSTS_PER_USER:
+                    break
+
+def _apply_events_to_agg_bulk(evs: List[Event]) -> None:
+    """نسخه‌ی گروهیِ _apply_event_to_agg."""
+    _merge_partial(_fold_events(evs, {}))
 
-async def tail_file(path: str) -> None:
-    """فایل را دنبال می‌کند و رویدادهای جدید را به AGG و recent_events اضافه و برای SSE پخش می‌کند."""
+async def tail_file(path: str, resume: Optional[Tuple[int, int]] = None) -> None:
+    """
+    فایل را دنبال می‌کند و رویدادهای جدید را به AGG و recent_events اضافه و برای SSE پخش می‌کند.
+    resume: (inode, offset) جایی که _load_user_tail در replay متوقف شد؛ اگر هنوز همان فایل
+    باشد، خطوط بینِ آن offset و انتهای فعلی هم (فقط برای USER_TAIL) خوانده می‌شوند.
+    """
+    global USER_TAIL_FROM
     f = None
     inode = None
     first_open = True
+    next_persist = time.monotonic() + USER_TAIL_PERSIST_SEC
+    ino = None
+    if TAIL_USE_INOTIFY:
+        try:
+            ino = Inotify()
+        except OSError as e:  # مثلاً سقف fs.inotify.max_user_instances
+            logger.warning(f"[tail_file] inotify unavailable ({e}); polling every {TAIL_POLL_SEC}s")
+    watch = None
     while True:
         try:
             if f is None:
-                f = open(path, "r", encoding="utf-8", errors="ignore")
+                f = open(path, "rb")  # باینری: tell() آفست دقیق بایت می‌دهد
                 st = os.fstat(f.fileno())
                 inode = st.st_ino
                 if first_open:
-                    f.seek(0, os.SEEK_END)  # فقط خطوط جدید
-                    first_open = False
+                    if resume is not None and resume[0] == inode:
+                        # خطوطی که بعد از replay اضافه شده‌اند؛ AGG را full-scan می‌شمارد
+                        f.seek(resume[1])
+                        _replay_user_tail(f)
+                    else:
+                        if USER_TAIL:
+                            # بین بازیابی و این open فایل عوض شده؛ tail بازیابی‌شده دیگر پیوسته نیست
+                            _user_tail_clear()
+                        f.seek(0, os.SEEK_END)  # فقط خطوط جدید
+                        USER_TAIL_FROM = f.tell()  # اندیس از همین‌جا شروع می‌شود
                 else:
                     f.seek(0, os.SEEK_SET)  # پس از rotation
-                logger.info(f"Tailing file: {path} (inode={inode})")
+                    USER_TAIL_FROM = 0
+                    # هر deque از این‌جا به بعد کل فایل تازه را دارد
+                    USER_TAIL_EVICTED.clear()
+                if ino is not None:
+                    if watch is not None:
+                        try:
+                            ino.rm_watch(watch)
+                        except Exception:
+                            pass  # watch فایل حذف‌شده خودکار برداشته می‌شود
+                        watch = None
+                    try:
+                        # ATTRIB: حذف فایلِ باز فقط link count را عوض می‌کند
+                        watch = ino.add_watch(path, Mask.MODIFY | Mask.MOVE_SELF | Mask.DELETE_SELF | Mask.ATTRIB)
+                    except OSError as e:  # مثلاً ENOSPC از سقف max_user_watches
+                        logger.warning(f"[tail_file] inotify watch failed ({e}); polling every {TAIL_POLL_SEC}s")
+                        try:
+                            ino.close()
+                        except Exception:
+                            pass
+                        ino = None
+                # فقط بعد از راه‌اندازی کامل؛ وگرنه خطای بعدی فایل را از ابتدا دوباره می‌خواند
+                first_open = False
+                logger.info(f"Tailing file: {path} (inode={inode}, inotify={ino is not None})")
 
             line = f.readline()
             if line:
-                ev = parse_line(line.rstrip("\n"))
+                ev = parse_line(line.decode("utf-8", errors="ignore"))
                 if ev:
-                    recent_events.append(ev)
+                    ts, user, host = ev
+                    recent_events.append(ts, user, host)
                     _apply_event_to_agg(ev)
-                    await broadcaster.broadcast(
-                        {"ts": ev["ts"], "user": ev["user"], "base": base_user(ev["user"]), "host": ev["host"]}
-                    )
+                    broadcaster.publish((ts, user, base_user(user), host, pack_ts(ts)))
             else:
                 # بررسی rotation
                 try:
@@ -300,7 +845,19 @@ async def tail_file(path: str) -> None:
                     await asyncio.sleep(0.5)
                     continue
 
-                await asyncio.sleep(0.2)
+                # تا انتهای فایل رسیده‌ایم؛ USER_TAIL دقیقاً با این offset هم‌خوان است
+                if time.monotonic() >= next_persist:
+                    next_persist = time.monotonic() + USER_TAIL_PERSIST_SEC
+                    await _persist_user_tail(inode, f.tell())
+
+                if ino is not None:
+                    # تا MODIFY (داده‌ی جدید) یا MOVE_SELF/DELETE_SELF/ATTRIB (rotation) صبر کن
+                    try:
+                        await asyncio.wait_for(ino.get(), timeout=TAIL_INOTIFY_TIMEOUT_SEC)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await asyncio.sleep(TAIL_POLL_SEC)
         except FileNotFoundError:
             logger.warning("Log file not found; waiting...")
             await asyncio.sleep(0.5)
@@ -315,55 +872,211 @@ async def tail_file(path: str) -> None:
             inode = None
             await asyncio.sleep(1.0)
 
+def _save_user_tail(parts: List[bytes]) -> None:
+    tmp = USER_TAIL_FILE + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.writelines(parts)
+    os.replace(tmp, USER_TAIL_FILE)
+
+async def _persist_user_tail(inode: Optional[int], offset: int) -> None:
+    """
+    ذخیره‌ی USER_TAIL همراه با inode/offset فایلی که تا آن‌جا خوانده شده.
+    اگر از آخرین ذخیره چیزی عوض نشده کاری نمی‌کند. json/orjson در thread هم GIL را
+    رها نمی‌کنند، پس سریال‌سازی base به base روی همین loop انجام می‌شود و هر
+    USER_TAIL_PERSIST_SLICE_SEC یک‌بار به بقیه‌ی کارها (SSE و API) فرصت می‌دهد؛
+    tail_file در این فاصله منتظر همین تابع است و USER_TAIL ثابت می‌ماند.
+    """
+    global USER_TAIL_DIRTY, _USER_TAIL_SAVED_INODE
+    if not USER_TAIL_DIRTY and _USER_TAIL_SAVED_INODE == inode:
+        return
+    USER_TAIL_DIRTY = False
+    parts = [
+        b'{"inode":' + json_bytes(inode) + b',"offset":' + json_bytes(offset)
+        + b',"tail_from":' + json_bytes(USER_TAIL_FROM)
+        + b',"evicted":' + json_bytes(list(USER_TAIL_EVICTED)) + b',"tails":{'
+    ]
+    sep = b""
+    deadline = time.monotonic() + USER_TAIL_PERSIST_SLICE_SEC
+    for b, dq in list(USER_TAIL.items()):
+        parts.append(sep + json_bytes(b) + b":" + json_bytes(list(dq)))
+        sep = b","
+        if time.monotonic() >= deadline:
+            await asyncio.sleep(0)
+            deadline = time.monotonic() + USER_TAIL_PERSIST_SLICE_SEC
+    parts.append(b"}}")
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, _save_user_tail, parts)
+        _USER_TAIL_SAVED_INODE = inode
+    except Exception as e:
+        _USER_TAIL_SAVED_INODE = None  # دفعه‌ی بعد حتماً دوباره تلاش شود
+        logger.warning(f"[user-tail] persist failed: {e}")
+
+def _replay_user_tail(f) -> int:
+    """
+    خطوط کامل فایل از موقعیت فعلی f تا انتها را فقط به USER_TAIL اضافه می‌کند.
+    خطِ آخرِ ناتمام (بدون '\n') خوانده نمی‌شود و f درست قبل از آن می‌ماند.
+    خروجی: تعداد رخدادهای اضافه‌شده.
+    """
+    global USER_TAIL_DIRTY
+    replayed = 0
+    pos = f.tell()
+    for line in f:
+        if not line.endswith(b"\n"):
+            break
+        pos += len(line)
+        ev = parse_line(line.decode("utf-8", errors="ignore"))
+        if ev:
+            user, b = user_and_base(ev[1])
+            _user_tail_add(b, (ev[0], user, shared_host(ev[2])))
+            replayed += 1
+    f.seek(pos)
+    if replayed:
+        USER_TAIL_DIRTY = True
+    return replayed
+
+def _load_user_tail(path: str) -> Optional[Tuple[int, int]]:
+    """
+    بازیابی USER_TAIL از دیسک؛ فقط اگر هنوز همان فایل باشد (inode یکسان).
+    خطوطی که بعد از آخرین ذخیره به فایل اضافه شده‌اند هم دوباره خوانده می‌شوند
+    تا اندیس پیوسته بماند. (AGG را full-scan می‌سازد؛ این‌جا فقط USER_TAIL.)
+    خروجی: (inode, offset) پایان آخرین خط کاملِ replay‌شده، که tail_file از همان‌جا
+    ادامه می‌دهد؛ None اگر چیزی بازیابی نشد.
+    """
+    global _USER_TAIL_SAVED_INODE, USER_TAIL_FROM, USER_TAIL_EVENTS
+    try:
+        with open(USER_TAIL_FILE, "r", encoding="utf-8") as fh:
+            snapshot = json.load(fh)
+        st = os.stat(path)
+        offset = int(snapshot.get("offset") or 0)
+        if snapshot.get("inode") != st.st_ino or offset > st.st_size:
+            logger.info("[user-tail] persisted tail is stale; ignoring")
+            return None
+        # json برای هر مقدار رشته‌ی تازه می‌سازد؛ نام‌ها از _BASE_CACHE و hostها از یک
+        # dict محلی یک نسخه‌ی مشترک می‌گیرند
+        hosts: Dict[str, str] = {}
+        h1 = hosts.setdefault
+        for b, evs in (snapshot.get("tails") or {}).items():
+            dq = USER_TAIL[b] = deque(
+                ((ts, user_and_base(u)[0], h1(h, h)) for ts, u, h in evs), maxlen=USER_TAIL_MAX
+            )
+            USER_TAIL_EVENTS += len(dq)
+        USER_TAIL_EVICTED.update(snapshot.get("evicted") or ())
+        _user_tail_trim()
+        tail_from = snapshot.get("tail_from")
+        USER_TAIL_FROM = tail_from if isinstance(tail_from, int) and 0 <= tail_from <= offset else None
+        with open(path, "rb") as f:
+            f.seek(offset)
+            replayed = _replay_user_tail(f)
+            stop = f.tell()
+        # فایل روی دیسک با همین inode معتبر است؛ فقط خطوط replay‌شده هنوز ذخیره نشده‌اند
+        _USER_TAIL_SAVED_INODE = st.st_ino
+        logger.info(f"[user-tail] restored {len(USER_TAIL)} bases (+{replayed} lines since last save)")
+        return st.st_ino, stop
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"[user-tail] restore failed: {e}")
+    # بازیابی نیمه‌کاره نباید بماند؛ tail_file اندیس را از انتهای فایل شروع می‌کند
+    _user_tail_clear()
+    USER_TAIL_FROM = None
+    return None
+
 # -----------------------------
 # خواندن تاریخچه از فایل (paging)
 # -----------------------------
-def _iter_file_backward(path: str, chunk_size: int = 1 << 16):
-    """ژنراتور خطوط فایل از انتها به ابتدا، بدون بارگذاری کل فایل در حافظه."""
+def _iter_file_backward(path: str, end: Optional[int] = None, chunk_size: int = 1 << 16):
+    """
+    ژنراتور (offset شروع خط، خط خام bytes) از انتهای فایل (یا از بایت end، انحصاری)
+    به ابتدا، بدون بارگذاری کل فایل در حافظه.
+    """
     with open(path, "rb") as f:
-        f.seek(0, os.SEEK_END)
+        size = f.seek(0, os.SEEK_END)
+        pos = size if end is None else min(end, size)
         buffer = b""
-        pos = f.tell()
         while pos > 0:
             read_size = min(chunk_size, pos)
             pos -= read_size
             f.seek(pos)
             data = f.read(read_size)
             buffer = data + buffer
-            *lines, buffer = buffer.split(b"\n")
-            for line in reversed(lines):
-                yield line.decode("utf-8", errors="ignore")
+            # تکه‌ی اول ممکن است ادامه‌ی خطی از chunk قبلی (عقب‌تر) باشد؛ نگهش می‌داریم
+            buffer, *lines = buffer.split(b"\n")
+            # خطوط کامل بعد از buffer قرار دارند
+            off = pos + len(buffer)
+            offs = []
+            for line in lines:
+                offs.append(off + 1)
+                off += 1 + len(line)
+            for start, line in zip(reversed(offs), reversed(lines)):
+                yield start, line
         if buffer:
             # ابتدای فایل
-            yield buffer.decode("utf-8", errors="ignore")
+            yield 0, buffer
 
 def tail_user_events(
     path: str,
     base: str,
     limit: int = 300,
     before_ts: Optional[str] = None,
-) -> List[Dict[str, str]]:
+    offset: Optional[int] = None,
+) -> Tuple[List[Dict[str, str]], Optional[int]]:
     """
     آخرین رخدادهای مربوط به base را از انتهای فایل جمع می‌کند.
     اگر before_ts داده شود، فقط رخدادهایی که ts < before_ts هستند لحاظ می‌شوند.
-    خروجی به ترتیب زمان صعودی بر می‌گردد.
+    اگر offset داده شود (next_offset صفحه‌ی قبل)، خواندن مستقیماً از همان بایت
+    به عقب ادامه پیدا می‌کند و before_ts نادیده گرفته می‌شود.
+    خروجی: (ردیف‌ها به ترتیب زمان صعودی، next_offset)
+    next_offset برای صفحه‌های فایل offset قدیمی‌ترین ردیف است (۰ یعنی ابتدای فایل)
+    و برای پاسخی که تمامش از USER_TAIL آمده، None (صفحه‌ی بعد با before_ts).
+    اول از USER_TAIL در حافظه جواب می‌دهیم؛ اگر deque کامل باشد (USER_TAIL_FROM) بقیه‌ی
+    صفحه از همان offset در فایل خوانده می‌شود، نه دوباره از انتهای فایل.
     """
     results: List[Dict[str, str]] = []
-    count = 0
-    for raw in _iter_file_backward(path):
-        ev = parse_line(raw.strip())
+    end = offset
+    if offset is None:
+        tail = USER_TAIL.get(base)
+        complete = (
+            USER_TAIL_FROM is not None
+            and base not in USER_TAIL_EVICTED
+            and (tail is None or len(tail) < (tail.maxlen or 0))
+        )
+        for ts, user, host in reversed(tail or ()):
+            if before_ts and ts >= before_ts:
+                continue
+            results.append({"ts": ts, "user": user, "host": host})
+            if len(results) >= limit:
+                results.reverse()  # صعودی
+                return results, None
+        if complete:
+            end = USER_TAIL_FROM  # رخدادهای بعد از این نقطه همین حالا از حافظه آمدند
+        elif results:
+            # deque به سقف رسیده و ابتدایش در فایل معلوم نیست؛ همین ردیف‌ها، ادامه با before_ts
+            results.reverse()
+            return results, None
+    else:
+        before_ts = None
+
+    # هر خطِ مربوط به base حتماً خودِ base را (به‌صورت bytes) در بر دارد؛
+    # پس خطوط دیگر را بدون decode و parse رد می‌کنیم.
+    needle = base.encode("utf-8")
+    next_offset = 0
+    for start, raw in _iter_file_backward(path, end=end):
+        if needle not in raw:
+            continue
+        ev = parse_line(raw.decode("utf-8", errors="ignore"))
         if not ev:
             continue
-        if before_ts and ev["ts"] >= before_ts:
+        ts, user, host = ev
+        if before_ts and ts >= before_ts:
             continue
-        if base_user(ev["user"]) != base:
+        if base_user(user) != base:
             continue
-        results.append(ev)
-        count += 1
-        if count >= limit:
+        results.append({"ts": ts, "user": user, "host": host})
+        if len(results) >= limit:
+            next_offset = start
             break
     results.reverse()  # صعودی
-    return results
+    return results, next_offset
 
 # -----------------------------
 # SSE
@@ -373,15 +1086,70 @@ async def sse_event_generator(q: asyncio.Queue) -> AsyncGenerator[bytes, None]:
         yield b": ok\n\n"
         while True:
             try:
-                msg = await asyncio.wait_for(q.get(), timeout=SSE_HEARTBEAT_SEC)
-                data = json.dumps(msg, ensure_ascii=False).encode("utf-8")
-                yield b"event: message\n"
-                yield b"data: " + data + b"\n\n"
+                # صف، frameهای از پیش سریال‌شده را نگه می‌دارد
+                yield await asyncio.wait_for(q.get(), timeout=SSE_HEARTBEAT_SEC)
             except asyncio.TimeoutError:
                 yield b": ping\n\n"
     except asyncio.CancelledError:
         return
 
+# -----------------------------
+# Snapshot کاربران (برای /api/users)
+# -----------------------------
+# نمای آماده‌ی هر base برای پاسخ (base -> item) و JSON آماده‌ی حالت پیش‌فرض UI
+# (top-N بر اساس last_ts). AGG_VIEW فقط برای baseهای AGG_DIRTY از نو ساخته می‌شود.
+AGG_VIEW: Dict[str, Dict[str, object]] = {}
+SNAPSHOT_JSON: bytes = b"[]"
+SNAPSHOT_ETAG: str = etag_of(SNAPSHOT_JSON)
+
+def _build_view(b: str, a: Dict[str, object]) -> Dict[str, object]:
+    """item خروجی /api/users برای یک base."""
+    display = sorted(a["variants"]) if a.get("variants") else [b]
+    host_ids = list(islice(a["hosts"], MAX_HOSTS_PER_USER))
+    hosts = [HOST_STR[i] for i in host_ids]
+    # host پورن (اگر باشد) هنگام ورود پیدا شده؛ این‌جا فقط خوانده می‌شود
+    prio = a["porn_host"]
+    sample = a["sample_host"] if prio is None else HOST_STR[prio]
+
+    return {
+        "base": b,
+        "display_names": display,
+        "count": a["count"],
+        "last_ts": a["last_ts"],
+        "last_ts_int": a["last_ts_int"],
+        "sample_host": sample,
+        "hosts": hosts,
+    }
+
+def _build_users_snapshot() -> None:
+    global AGG_DIRTY, SNAPSHOT_JSON, SNAPSHOT_ETAG
+    if not AGG_DIRTY:
+        return  # از ساخت قبلی چیزی عوض نشده
+    dirty, AGG_DIRTY = AGG_DIRTY, set()
+    for b in dirty:
+        AGG_VIEW[b] = _build_view(b, AGG[b])
+    # مرتب‌سازی کامل لازم نیست؛ فقط USERS_DEFAULT_LIMIT تای جدیدتر (O(N log k))
+    top = heapq.nlargest(USERS_DEFAULT_LIMIT, AGG_VIEW.values(), key=itemgetter("last_ts_int"))
+    SNAPSHOT_JSON = json_bytes(top)
+    SNAPSHOT_ETAG = etag_of(SNAPSHOT_JSON)
+
+async def _snapshot_refresher() -> None:
+    """
+    هر SNAPSHOT_REFRESH_SEC ثانیه نمای baseهای تغییرکرده و JSON پیش‌فرض را به‌روز می‌کند؛ اگر در این فاصله
+    بیش از SNAPSHOT_GROWTH_TRIGGER base جدید اضافه شود، زودتر.
+    """
+    while True:
+        try:
+            _build_users_snapshot()
+        except Exception as e:
+            logger.exception(f"[snapshot] build failed: {e}")
+        built_size = len(AGG)
+        deadline = time.monotonic() + SNAPSHOT_REFRESH_SEC
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SNAPSHOT_CHECK_SEC)
+            if len(AGG) - built_size > SNAPSHOT_GROWTH_TRIGGER:
+                break
+
 # -----------------------------
 # وب‌اپ
 # -----------------------------
@@ -530,20 +1298,32 @@ try { dayjs.calendar('jalali'); } catch(e) {}
 
 
 const tz = 'Asia/Tehran';
+// تبدیل dayjs گران است و همان ts بارها در رندرهای مودال/گرید تکرار می‌شود
+const JALALI_CACHE_MAX = 5000;
+const jalaliCache = new Map();
 function toJalaliTehran(ts){
+  let v = jalaliCache.get(ts);
+  if(v !== undefined) return v;
   try{
     const d = dayjs.tz(ts, tz);
     const j = d.calendar ? d.calendar('jalali') : d;
-    return j.format('YYYY-MM-DD HH:mm:ss');
-  }catch(e){ return ts; }
+    v = j.format('YYYY-MM-DD HH:mm:ss');
+  }catch(e){ v = ts; }
+  if(jalaliCache.size >= JALALI_CACHE_MAX) jalaliCache.clear();
+  jalaliCache.set(ts, v);
+  return v;
 }
 
 // ---------- State ----------
-let usersMap = new Map(); // base -> {base, display_names[], count, last_ts, sample_host, warn, deac, hosts[]}
+let usersMap = new Map(); // base -> {base, display_names[], count, last_ts, last_ts_int, sample_host, warn, deac, hosts[]}
+const gridTiles = new Map(); // base -> {el, countEl, warnEl, deacEl, namesEl, sampleEl, tsEl} برای کارت‌های فعلی گرید
+const dirtyBases = new Set(); // baseهایی که از آخرین رندر، رخداد زنده گرفته‌اند
 let statsMode = null;     // 'warn' | 'deac' | null
 let modalBase = null;
-let modalOldestTs = null; // cursor for paging older
+let modalOldestTs = null; // cursor for paging older (وقتی سرور از حافظه جواب داده)
+let modalNextOffset = null; // کِرسور offset فایل که سرور برمی‌گرداند؛ ۰ یعنی ابتدای فایل
 let modalAll = [];        // current list in modal
+let modalRendered = [];   // ردیف‌هایی که الان (به همین ترتیب) در مودال نمایش داده شده‌اند
 let livePaused = false;
 const liveDot = document.getElementById('live-dot');
 
@@ -553,19 +1333,41 @@ const emptyEl = document.getElementById('empty');
 const statUsers = document.getElementById('stat-users');
 const statLogs  = document.getElementById('stat-logs');
 const statLast  = document.getElementById('stat-last');
-const PAGE_SIZE = 80000; // یا 5000، مطابق سقف سرور
+const PAGE_SIZE = 10000; // مطابق سقف limit در /api/user_events
 
 let cancelModalLoad = false; // برای قطع‌کردن لود وقتی مودال بسته شد
 
 function sleep(ms){ return new Promise(r => setTimeout(r, ms)); }
-function pickSampleHost(hosts, currentSample){
-  if (Array.isArray(hosts)) {
-    const hit = hosts.find(h => (h||'').toLowerCase().includes('porn'));
-    if (hit) return hit;
-    if (currentSample && hosts.includes(currentSample)) return currentSample;
-    return hosts[0] || currentSample || '';
-  }
-  return currentSample || '';
+// کار غیرفوری در زمان بیکاری مرورگر؛ حداکثر تا timeoutMs صبر.
+// Safari و مرورگرهای بدون requestIdleCallback: در اولین فرصت با setTimeout
+const whenIdle = window.requestIdleCallback
+  ? (fn, timeoutMs)=> requestIdleCallback(fn, {timeout: timeoutMs})
+  : (fn)=> setTimeout(fn, 0);
+const cancelIdle = window.cancelIdleCallback
+  ? (h)=>{ if(h !== null) cancelIdleCallback(h); }
+  : (h)=> clearTimeout(h);
+// debounce واقعی برای تایپ: fn فقط waitMs بعد از آخرین فراخوانی، آن هم در زمان بیکاری
+// (requestIdleCallback به‌تنهایی debounce نیست و معمولاً چند میلی‌ثانیه بعد از هر کلید اجرا می‌شود)
+function idleDebounce(fn, waitMs, idleTimeoutMs = 100){
+  let timer = null, idle = null;
+  return ()=>{
+    clearTimeout(timer);
+    cancelIdle(idle);
+    idle = null;
+    timer = setTimeout(()=>{
+      timer = null;
+      idle = whenIdle(()=>{ idle = null; fn(); }, idleTimeoutMs);
+    }, waitMs);
+  };
+}
+// نسخه‌ی lowercase فیلدهای جست‌وجو، یک‌بار هنگام ورود به usersMap
+function indexUserLc(it){
+  it.base_lc = (it.base||'').toLowerCase();
+  it.names_lc = (it.display_names||[]).map(d => (d||'').toLowerCase());
+  it.hosts_lc = (it.hosts||[]).map(h => (h||'').toLowerCase());
+  // sample_host سرور از قبل اولویت پورن را دارد؛ رخدادهای زنده فقط همین پرچم را نگه می‌دارند
+  it.sample_porn = isPornHost(it.sample_host);
+  return it;
 }
 
 const searchUserEl = document.getElementById('search-user');
@@ -606,9 +1408,11 @@ btnCloseStats.onclick = hideStatsModal;
 
 // ---------- API Helpers ----------
 
+// همان PORN_KEYWORDS سمت سرور؛ یک‌بار کامپایل و نتیجه روی ردیف (r.isPorn) کش می‌شود
+const PORN_KEYWORDS = ['porn'];
+const PORN_RE = new RegExp(PORN_KEYWORDS.map(k => k.replace(/[.*+?^${}()|[\]\\]/g, '\\$&')).join('|'), 'i');
 function isPornHost(h){
-  if(!h) return false;
-  return String(h).toLowerCase().includes('porn');
+  return !!h && PORN_RE.test(h);
 }
 
 
@@ -616,55 +1420,58 @@ async function preloadAllForModal(){
   if(!modalBase) return;
   const baseAtOpen = modalBase;          // محافظ تعویض یوزر
   let pages = 0;
-  let lastCursor = null;
 
-  while(!cancelModalLoad && baseAtOpen === modalBase){
+  while(!cancelModalLoad && baseAtOpen === modalBase && modalNextOffset !== 0){
     const cursorBefore = modalOldestTs;  // کِرسور قبلی برای تشخیص گیر
-    const page = await fetchUserEvents(baseAtOpen, PAGE_SIZE, cursorBefore);
-
-    if(cancelModalLoad || baseAtOpen !== modalBase) return;
-
-    if(!page.length){
-      // اگر خالی برگشت ولی هنوز cursor عوض نشده، تلاش آخر با کمی تأخیر
-      if (cursorBefore && lastCursor !== '__retry__') {
-        lastCursor = '__retry__';
-        await sleep(60);
-        continue;
-      }
-      break;
-    }
-
-    modalAll = modalAll.concat(page);
+    const page = await fetchModalPage(baseAtOpen);
+    if(!page || !page.length) break;
 
-    // توجه: سرور نتایج را «صعودی» برمی‌گرداند => قدیمی‌ترینِ این صفحه index صفر است
-    const newCursor = page[0]?.ts || cursorBefore;
-
-    // اگر cursor تغییری نکرد، یعنی به تهٔ بازه رسیدیم یا تایم‌استمپ‌ها برابرند
-    if (newCursor === cursorBefore) break;
+    // در حالت ts: اگر cursor تغییری نکرد، یعنی به تهٔ بازه رسیدیم یا تایم‌استمپ‌ها برابرند
+    if(modalNextOffset === null && modalOldestTs === cursorBefore) break;
 
-    modalOldestTs = newCursor;
-    lastCursor = modalOldestTs;
     renderModal();
-
     if(++pages % 5 === 0) await sleep(40); // نفس برای UI
   }
 }
 
+// صفحه‌ی قدیمی‌تر بعدی را با کِرسور فعلی می‌گیرد و به modalAll اضافه می‌کند
+async function fetchModalPage(base){
+  const {rows, next_offset} = await fetchUserEvents(base, PAGE_SIZE, modalOldestTs, modalNextOffset);
+  if(cancelModalLoad || base !== modalBase) return null;
+  if(rows.length){
+    modalAll = modalAll.concat(rows);
+    // توجه: سرور نتایج را «صعودی» برمی‌گرداند => قدیمی‌ترینِ این صفحه index صفر است
+    modalOldestTs = rows[0].ts;
+  }
+  modalNextOffset = next_offset;
+  return rows;
+}
+
+
+// ETag آخرین پاسخ‌ها؛ poll دوره‌ای با If-None-Match می‌پرسد و اگر 304 آمد چیزی بازسازی نمی‌شود
+let usersEtag = null;
+let statsEtag = null;
+let statsNorm = {};       // آخرین آمار نرمال‌شده (base -> {warnings_after_second, deactivated_times})
+function conditional(etag){ return etag ? {headers: {'If-None-Match': etag}} : undefined; }
 
+// true یعنی usersMap از نو ساخته شد؛ false یعنی سرور گفت چیزی عوض نشده (304)
 async function fetchUsersSnapshot(){
   const u = encodeURIComponent(searchUserEl.value||'');
   const s = encodeURIComponent(searchSiteEl.value||'');
-  const resp = await fetch(`/api/users?user_q=${u}&site_q=${s}&limit=600`);
+  const resp = await fetch(`/api/users?user_q=${u}&site_q=${s}&limit=600`, conditional(usersEtag));
+  if(resp.status === 304) return false;
+  usersEtag = resp.headers.get('ETag');
   const data = await resp.json();
   // rebuild map
   usersMap.clear();
   for(const it of data){
-    usersMap.set(it.base, it);
+    usersMap.set(it.base, indexUserLc(it));
   }
   statUsers.textContent = String(usersMap.size);
   statLogs.textContent = '≈' + String(5000); // نشان‌دهنده‌ی حافظه‌ی زنده؛ فایل حذف نمی‌شود
   const last = data.length ? data[0].last_ts : null;
   statLast.textContent = last ? toJalaliTehran(last) : '—';
+  return true;
 }
 
 async function pollScan(){
@@ -686,40 +1493,56 @@ setInterval(pollScan, 1000);
 pollScan();
 
 
-async function fetchUserEvents(base, limit=300, beforeTs=null){
+async function fetchUserEvents(base, limit=300, beforeTs=null, offset=null){
   const url = new URL(location.origin + '/api/user_events');
   url.searchParams.set('base', base);
   url.searchParams.set('limit', limit);
-  if(beforeTs) url.searchParams.set('before_ts', beforeTs);
+  // offset دقیق‌تر و ارزان‌تر است (سرور مستقیماً seek می‌کند)؛ before_ts فقط وقتی offset نداریم
+  if(offset !== null) url.searchParams.set('offset', offset);
+  else if(beforeTs) url.searchParams.set('before_ts', beforeTs);
   const resp = await fetch(url);
-  return await resp.json();
+  const data = await resp.json();
+  const page = data.rows || [];
+  for(const r of page){
+    r.host_lc = (r.host||'').toLowerCase();
+    r.isPorn = isPornHost(r.host);
+  }
+  return {rows: page, next_offset: data.next_offset ?? null};
 }
 
-async function refreshStats(){
+// force: usersMap تازه ساخته شده و آمار (حتی اگر 304 باشد) باید دوباره روی آن ادغام شود
+async function refreshStats(force){
   try{
-    const resp = await fetch('/api/stats');
-    const raw = await resp.json();
-    // normalize to base
-    const norm = {};
-    for(const k in raw){
-      const i = k.indexOf('.');
-      let b = k;
-      if(i>0 && /^[0-9]+$/.test(k.slice(0,i))) b = k.slice(i+1);
-      if(!norm[b]) norm[b] = {warnings_after_second:0, deactivated_times:0};
-      const v = raw[k] || {};
-      norm[b].warnings_after_second += Number(v.warnings_after_second||0);
-      norm[b].deactivated_times     += Number(v.deactivated_times||0);
+    const resp = await fetch('/api/stats', conditional(statsEtag));
+    if(resp.status === 304){
+      if(!force) return false;
+    }else{
+      const raw = await resp.json();
+      statsEtag = resp.headers.get('ETag');
+      // normalize to base
+      const norm = {};
+      for(const k in raw){
+        const i = k.indexOf('.');
+        let b = k;
+        if(i>0 && /^[0-9]+$/.test(k.slice(0,i))) b = k.slice(i+1);
+        if(!norm[b]) norm[b] = {warnings_after_second:0, deactivated_times:0};
+        const v = raw[k] || {};
+        norm[b].warnings_after_second += Number(v.warnings_after_second||0);
+        norm[b].deactivated_times     += Number(v.deactivated_times||0);
+      }
+      statsNorm = norm;
     }
     // merge into usersMap
     for(const [b, it] of usersMap.entries()){
-      const st = norm[b] || {warnings_after_second:0, deactivated_times:0};
+      const st = statsNorm[b] || {warnings_after_second:0, deactivated_times:0};
       it.warn = st.warnings_after_second || 0;
       it.deac = st.deactivated_times || 0;
       usersMap.set(b, it);
     }
     // if stats modal open, rerender
     if(statsMode) renderStats();
-  }catch(e){}
+    return true;
+  }catch(e){ return false; }
 }
 
 // ---------- Rendering ----------
@@ -729,45 +1552,104 @@ function renderGrid(){
 
   let arr = Array.from(usersMap.values());
   if(qUser){
-    arr = arr.filter(x => {
-      if((x.base||'').toLowerCase().includes(qUser)) return true;
-      return x.display_names.some(d => (d||'').toLowerCase().includes(qUser));
-    });
+    arr = arr.filter(x => x.base_lc.includes(qUser) || x.names_lc.some(d => d.includes(qUser)));
   }
   if(qSite){
-    arr = arr.filter(x => (x.hosts||[]).some(h => (h||'').toLowerCase().includes(qSite)));
+    arr = arr.filter(x => x.hosts_lc.some(h => h.includes(qSite)));
   }
-  arr.sort((a,b)=> (b.last_ts||'').localeCompare(a.last_ts||''));
+  arr.sort((a,b)=> (b.last_ts_int||0) - (a.last_ts_int||0));
 
   const MAX_CARDS = 500;
   const sliced = arr.slice(0, MAX_CARDS);
-  gridEl.innerHTML='';
-  if(!sliced.length){ emptyEl.classList.remove('hidden'); return; }
-  emptyEl.classList.add('hidden');
+  dirtyBases.clear(); // رندر کامل همه‌ی تغییرات معوق را پوشش می‌دهد
 
-  const frag = document.createDocumentFragment();
+  // diff با کارت‌های فعلی: کارت‌های حذف‌شده جدا می‌شوند، جدیدها یک‌بار ساخته می‌شوند
+  // و بقیه فقط متنِ عوض‌شده‌شان را می‌گیرند و در صورت لزوم جابه‌جا می‌شوند
+  const keep = new Set(sliced.map(it => it.base));
+  for(const [b, tile] of gridTiles){
+    if(!keep.has(b)){ tile.el.remove(); gridTiles.delete(b); }
+  }
+  emptyEl.classList.toggle('hidden', sliced.length > 0);
+
+  let ref = gridEl.firstChild;
   for(const it of sliced){
-    const warn = Number(it.warn||0);
-    const deac = Number(it.deac||0);
-    const card = document.createElement('button');
-    card.className = 'group text-right rounded-2xl p-4 card hover:shadow-glow transition';
-    card.innerHTML = `
-      <div class="flex items-center justify-between gap-2">
-        <div class="font-semibold truncate max-w-[60%]">${it.base}</div>
-        <div class="flex items-center gap-1">
-          <span class="text-xs px-2 py-0.5 rounded-full chip">${it.count}</span>
-          <span class="text-xs px-2 py-0.5 rounded-full chip-amber">⚠️ ${warn}</span>
-          <span class="text-xs px-2 py-0.5 rounded-full chip-red">⛔ ${deac}</span>
-        </div>
-      </div>
-      <div class="mt-1 text-xs opacity-70 truncate">${(it.display_names||[]).join('، ')}</div>
-      <div class="mt-2 text-sm opacity-80 truncate">نمونه سایت: ${it.sample_host || '—'}</div>
-      <div class="mt-2 text-xs opacity-60">آخرین فعالیت: ${it.last_ts ? toJalaliTehran(it.last_ts) : '—'}</div>
-    `;
-    card.onclick = ()=> openBase(it.base);
-    frag.appendChild(card);
+    let tile = gridTiles.get(it.base);
+    if(!tile){
+      tile = buildTile(it.base);
+      gridTiles.set(it.base, tile);
+    }
+    updateTile(tile, it);
+    if(tile.el === ref) ref = ref.nextSibling;
+    else gridEl.insertBefore(tile.el, ref);
   }
-  gridEl.appendChild(frag);
+}
+
+function makeEl(tag, className, text){
+  const el = document.createElement(tag);
+  el.className = className;
+  if(text !== undefined) el.textContent = text;
+  return el;
+}
+function setText(el, v){
+  v = String(v);
+  if(el.textContent !== v) el.textContent = v; // فقط اگر واقعاً عوض شده
+}
+
+// ساختار کارت یک base یک‌بار ساخته می‌شود؛ مقدارها را updateTile می‌نویسد
+function buildTile(base){
+  const card = makeEl('button', 'group text-right rounded-2xl p-4 card hover:shadow-glow transition');
+  card.dataset.base = base;
+  card.onclick = ()=> openBase(base);
+
+  const head = makeEl('div', 'flex items-center justify-between gap-2');
+  const chips = makeEl('div', 'flex items-center gap-1');
+  const countEl = makeEl('span', 'text-xs px-2 py-0.5 rounded-full chip');
+  const warnEl = makeEl('span', 'text-xs px-2 py-0.5 rounded-full chip-amber');
+  const deacEl = makeEl('span', 'text-xs px-2 py-0.5 rounded-full chip-red');
+  chips.append(countEl, warnEl, deacEl);
+  head.append(makeEl('div', 'font-semibold truncate max-w-[60%]', base), chips);
+
+  const namesEl = makeEl('div', 'mt-1 text-xs opacity-70 truncate');
+  const sampleEl = makeEl('span', '');
+  const sampleRow = makeEl('div', 'mt-2 text-sm opacity-80 truncate', 'نمونه سایت: ');
+  sampleRow.appendChild(sampleEl);
+  const tsEl = makeEl('span', '');
+  const tsRow = makeEl('div', 'mt-2 text-xs opacity-60', 'آخرین فعالیت: ');
+  tsRow.appendChild(tsEl);
+
+  card.append(head, namesEl, sampleRow, tsRow);
+  return {el: card, countEl, warnEl, deacEl, namesEl, sampleEl, tsEl};
+}
+
+function updateTile(tile, it){
+  setText(tile.countEl, it.count);
+  setText(tile.warnEl, `⚠️ ${Number(it.warn||0)}`);
+  setText(tile.deacEl, `⛔ ${Number(it.deac||0)}`);
+  setText(tile.namesEl, (it.display_names||[]).join('، '));
+  setText(tile.sampleEl, it.sample_host || '—');
+  setText(tile.tsEl, it.last_ts ? toJalaliTehran(it.last_ts) : '—');
+}
+
+// به‌روزرسانی درجا فقط برای baseهای تغییرکرده؛ اگر اصلاح محلی کافی نباشد false
+function patchDirtyTiles(){
+  const tiles = [];
+  for(const b of dirtyBases){
+    const tile = gridTiles.get(b), it = usersMap.get(b);
+    if(!tile || !it) return false; // base جدید یا خارج از کارت‌های فعلی
+    tiles.push([it, tile]);
+  }
+  // گرید بر اساس last_ts نزولی است؛ کارت‌های تغییرکرده باید همگی از بقیه جدیدتر باشند
+  tiles.sort((x, y)=> (x[0].last_ts_int||0) - (y[0].last_ts_int||0));
+  let first = gridEl.firstChild;
+  while(first && dirtyBases.has(first.dataset.base)) first = first.nextSibling;
+  if(first && tiles.length && (tiles[0][0].last_ts_int||0) < (usersMap.get(first.dataset.base)?.last_ts_int||0)) return false;
+
+  for(const [it, tile] of tiles){
+    updateTile(tile, it);
+    gridEl.insertBefore(tile.el, gridEl.firstChild);
+  }
+  dirtyBases.clear();
+  return true;
 }
 
 function showStats(mode){
@@ -834,6 +1716,7 @@ async function openBase(base){
   modalBase = base;
   modalAll = [];
   modalOldestTs = null;
+  modalNextOffset = null;
   cancelModalLoad = false;
 
   showModal();
@@ -849,73 +1732,96 @@ function hideModal(){
   modalBase = null;
   modalAll = [];
   modalOldestTs = null;
+  modalNextOffset = null;
+  modalRendered = [];
+  modalBody.replaceChildren(); // گره‌های ردیف‌ها هم با همین آزاد می‌شوند
   modalSearchEl.value = '';
 }
 
 
 async function loadMore(){
-  if(!modalBase) return;
-  const page = await fetchUserEvents(modalBase, PAGE_SIZE, modalOldestTs);
-  if(page.length){
-    modalAll = modalAll.concat(page);
-    modalOldestTs = page[0].ts;
-  }
+  if(!modalBase || modalNextOffset === 0) return; // به ابتدای فایل رسیده‌ایم
+  await fetchModalPage(modalBase);
 }
 
 
 function renderModal(){
   const q = (modalSearchEl.value||'').toLowerCase().trim();
-  const rows = modalAll.filter(r => !q || (r.host||'').toLowerCase().includes(q));
 
-  // اول پورن‌ها، بعد بقیه
-  const pornRows = [], otherRows = [];
-  for (const r of rows){
-    (isPornHost(r.host) ? pornRows : otherRows).push(r);
+  // فیلتر و «اول پورن‌ها، بعد بقیه» در یک گذر: پورن‌ها از سر آرایه، بقیه از ته آن
+  // (بقیه وارونه نوشته می‌شوند و هنگام رندر از آخر خوانده می‌شوند؛ ترتیب اصلی حفظ است)
+  const n = modalAll.length;
+  const ordered = new Array(n);
+  let head = 0, tail = n;
+  for(const r of modalAll){
+    if(q && !r.host_lc.includes(q)) continue;
+    if(r.isPorn) ordered[head++] = r; else ordered[--tail] = r;
   }
-  const ordered = pornRows.concat(otherRows);
+  const shown = head + (n - tail);
+
+  modalTitle.innerText = `گزارش — ${modalBase} (نمایش ${shown} از ${n})`;
 
-  modalTitle.innerText = `گزارش — ${modalBase} (نمایش ${ordered.length} از ${modalAll.length})`;
+  // هر ردیف گره‌ی DOM خودش را یک‌بار می‌سازد (r._node)؛ رندرهای بعدی فقط گره‌ها را
+  // به ترتیب جدید می‌چینند، بدون ساخت دوباره یا نوشتن متن
+  const visible = new Array(shown);
+  for(let i = 0; i < head; i++) visible[i] = ordered[i];
+  for(let i = head, k = n - 1; k >= tail; i++, k--) visible[i] = ordered[k];
+  if(visible.length === modalRendered.length && visible.every((r, i)=> r === modalRendered[i])) return;
 
   const frag = document.createDocumentFragment();
-  for(const r of ordered){
-    const row = document.createElement('div');
-    row.className = 'flex items-center justify-between rounded-2xl border border-white/10 bg-white/5 px-3 py-2';
-    row.innerHTML = `
-      <div class="truncate">
-        <div class="text-sm font_medium truncate">${r.host}</div>
-        <div class="text-xs opacity-70">${toJalaliTehran(r.ts)} — <span class="opacity-80">${r.user}</span></div>
-      </div>
-    `;
-    frag.appendChild(row);
-  }
-  modalBody.innerHTML='';
-  modalBody.appendChild(frag);
+  for(const r of visible) frag.appendChild(r._node || (r._node = buildModalRow(r)));
+  modalBody.replaceChildren(frag);
+  modalRendered = visible;
 } // ← این } حیاتی بود
 
+function buildModalRow(r){
+  const el = document.createElement('div');
+  el.className = 'flex items-center justify-between rounded-2xl border border-white/10 bg-white/5 px-3 py-2';
+  const wrap = document.createElement('div');
+  wrap.className = 'truncate';
+  const hostEl = document.createElement('div');
+  hostEl.className = 'text-sm font_medium truncate';
+  hostEl.textContent = r.host;
+  const meta = document.createElement('div');
+  meta.className = 'text-xs opacity-70';
+  const userEl = document.createElement('span');
+  userEl.className = 'opacity-80';
+  userEl.textContent = r.user;
+  meta.append(toJalaliTehran(r.ts) + ' — ', userEl);
+  wrap.append(hostEl, meta);
+  el.appendChild(wrap);
+  return el;
+}
+
 btnLoadMore.onclick = async ()=>{ await loadMore(); renderModal(); };
 
-let modalSearchTimer = null;
-modalSearchEl.addEventListener('input', ()=>{
-  clearTimeout(modalSearchTimer);
-  modalSearchTimer = setTimeout(()=> renderModal(), 120);
-});
+modalSearchEl.addEventListener('input', idleDebounce(()=> renderModal(), 120));
 
 
 
 // ---------- Controls ----------
+const CSV_BATCH = 1000; // تعداد ردیف در هر chunk استریم خروجی
+// نقل‌قول CSV (RFC 4180): فقط " دوبرابر می‌شود؛ بدون JSON.stringify برای هر فیلد
+const csvEsc = s => '"' + String(s).replace(/"/g, '""') + '"';
 btnExportAll.onclick = async ()=>{
-  const arr = Array.from(usersMap.values()).sort((a,b)=> (b.last_ts||'').localeCompare(a.last_ts||''));
-  const header = 'base,display_names,count,last_ts,sample_host,warn,deac\n';
-  const body = arr.map(it => [
-    JSON.stringify(it.base),
-    JSON.stringify((it.display_names||[]).join(' | ')),
-    it.count,
-    it.last_ts,
-    JSON.stringify(it.sample_host||''),
-    it.warn||0,
-    it.deac||0
-  ].join(',')).join('\n');
-  const blob = new Blob([header + body], {type:'text/csv;charset=utf-8;'});
+  const arr = Array.from(usersMap.values()).sort((a,b)=> (b.last_ts_int||0) - (a.last_ts_int||0));
+  const enc = new TextEncoder();
+  let i = 0;
+  // به‌جای یک رشته‌ی بزرگ، ردیف‌ها دسته‌دسته به stream اضافه می‌شوند
+  const stream = new ReadableStream({
+    start(ctrl){ ctrl.enqueue(enc.encode('base,display_names,count,last_ts,sample_host,warn,deac\n')); },
+    pull(ctrl){
+      if(i >= arr.length){ ctrl.close(); return; }
+      const end = Math.min(i + CSV_BATCH, arr.length);
+      let chunk = '';
+      for(; i < end; i++){
+        const it = arr[i];
+        chunk += `${csvEsc(it.base)},${csvEsc((it.display_names||[]).join(' | '))},${it.count},${it.last_ts},${csvEsc(it.sample_host||'')},${it.warn||0},${it.deac||0}\n`;
+      }
+      ctrl.enqueue(enc.encode(chunk)); // هر دسته یک‌بار به UTF-8
+    }
+  });
+  const blob = await new Response(stream, {headers: {'Content-Type': 'text/csv;charset=utf-8;'}}).blob();
   const url = URL.createObjectURL(blob); const a = document.createElement('a');
   a.href = url; a.download = 'users_snapshot.csv'; a.click(); URL.revokeObjectURL(url);
 };
@@ -931,45 +1837,65 @@ btnListDeac.onclick = ()=> showStats('deac');
 
 // ---------- Live (SSE) ----------
 let es = null;
-let dirtyCount = 0;
 let tickScheduled = false;
 function scheduleTick(){
   if(tickScheduled) return;
   tickScheduled = true;
-  setTimeout(()=>{
+  requestAnimationFrame(()=>{ // در تب پنهان مرورگر خودش متوقفش می‌کند
     tickScheduled = false;
-    if(!livePaused && dirtyCount>0){
-      renderGrid();
-      dirtyCount = 0;
+    if(livePaused || document.hidden || !dirtyBases.size) return;
+    if(!patchDirtyTiles()) renderGrid();
+  });
+}
+document.addEventListener('visibilitychange', ()=>{ if(!document.hidden && dirtyBases.size) scheduleTick(); });
+// ردیف فشرده‌ی SSE (ترتیب Broadcaster.publish سمت سرور) -> شیء رخداد
+function liveRow(r){ return {ts: r[0], user: r[1], base: r[2], host: r[3], ts_int: r[4]}; }
+function applyLiveEvent(data){
+  const base = data.base;
+  let it = usersMap.get(base);
+  if(!it){
+    it = indexUserLc({base: base, display_names: [data.user], count: 1, last_ts: data.ts, last_ts_int: data.ts_int, sample_host: data.host, warn: 0, deac: 0, hosts: [data.host]});
+  }else{
+    it.count = (it.count||0) + 1;
+    if(data.ts_int > (it.last_ts_int||0)) {
+      it.last_ts_int = data.ts_int;
+      it.last_ts = data.ts;
+      if(!it.sample_porn) it.sample_host = data.host;
+    }
+    if(!it.display_names.includes(data.user)){
+      it.display_names.push(data.user);
+      it.names_lc.push((data.user||'').toLowerCase());
+    }
+    // hostsSet کنار آرایه‌ی hosts زنده می‌ماند؛ هر رخداد فقط یک has و در صورت نیاز push
+    if(!it.hostsSet) it.hostsSet = new Set(it.hosts);
+    if(it.hostsSet.size < 200 && !it.hostsSet.has(data.host)){
+      it.hostsSet.add(data.host);
+      it.hosts.push(data.host);
+      it.hosts_lc.push((data.host||'').toLowerCase());
+      if(!it.sample_porn && isPornHost(data.host)){ it.sample_host = data.host; it.sample_porn = true; }
     }
-  }, 300); // batch UI updates every 300ms
+  }
+  usersMap.set(base, it);
+  dirtyBases.add(base);
 }
 function startLive(){
+  // اگر Worker در دسترس است، دریافت و parse در worker انجام می‌شود و این‌جا فقط اعمال
+  if(window.Worker){
+    const w = new Worker('/sse_worker.js');
+    w.onmessage = (e)=>{
+      if(livePaused) return;
+      for(const m of e.data) applyLiveEvent(m);
+      scheduleTick();
+    };
+    return;
+  }
   es = new EventSource('/api/events');
   es.onmessage = (ev)=>{
     try{
       if(livePaused) return;
       const data = JSON.parse(ev.data);
-      const base = data.base;
-      let it = usersMap.get(base);
-      if(!it){
-        it = {base: base, display_names: [data.user], count: 1, last_ts: data.ts, sample_host: data.host, warn: 0, deac: 0, hosts: [data.host]};
-      }else{
-        it.count = (it.count||0) + 1;
-        if(!it.last_ts || data.ts > it.last_ts) {
-          it.last_ts = data.ts;
-          it.sample_host = data.host;
-        }
-        if(!it.display_names.includes(data.user)) it.display_names.push(data.user);
-        const hs = new Set(it.hosts||[]);
-        if(hs.size < 200){ hs.add(data.host); }
-        it.hosts = Array.from(hs.values());        // ← بیرون if بگذار که همیشه ست شود
-        it.sample_host = pickSampleHost(it.hosts, it.sample_host);
-        
-
-      }
-      usersMap.set(base, it);
-      dirtyCount++;
+      // سرور رخدادها را دسته‌ای و فشرده می‌فرستد: {"rows": [[ts, user, base, host, ts_int], ...]}
+      for(const r of (data.rows || [])) applyLiveEvent(liveRow(r));
       scheduleTick();
     }catch(e){}
   };
@@ -977,24 +1903,21 @@ function startLive(){
 }
 
 // ---------- Filters ----------
-let inputTimer = null;
-function onInputChanged(){
-  clearTimeout(inputTimer);
-  inputTimer = setTimeout(()=> renderGrid(), 150);
-}
+const onInputChanged = idleDebounce(()=> renderGrid(), 150);
 searchUserEl.addEventListener('input', onInputChanged);
 searchSiteEl.addEventListener('input', onInputChanged);
 
 // ---------- Bootstrap ----------
 async function bootstrap(){
   await fetchUsersSnapshot();
-  await refreshStats();
+  await refreshStats(true);
   renderGrid();
   startLive();
+  // poll فقط تور ایمنی است (SSE خودش usersMap را زنده نگه می‌دارد)؛ بدون تغییر، رندری هم نیست
   setInterval(async ()=>{
-    await fetchUsersSnapshot();
-    await refreshStats();
-    renderGrid();
+    const usersChanged = await fetchUsersSnapshot();
+    const statsChanged = await refreshStats(usersChanged);
+    if(usersChanged || statsChanged) renderGrid();
   }, 10000);
 }
 bootstrap();
@@ -1003,6 +1926,55 @@ bootstrap();
 </html>
 """
 
+# Web Worker برای SSE: دریافت و JSON.parse خارج از thread اصلی UI
+SSE_WORKER_JS = r"""
+const FLUSH_MS = 50;       // فاصله‌ی ارسال دسته‌ها به thread اصلی
+const RETRY_MS = 3000;     // مثل EventSource پس از قطع، دوباره وصل شو
+let pending = [];
+
+function handleFrame(frame){
+  let data = '';
+  for(const line of frame.split('\n')){
+    if(line.startsWith('data:')) data += (data ? '\n' : '') + line.slice(line[5] === ' ' ? 6 : 5);
+  }
+  if(!data) return; // heartbeat/comment
+  try{
+    const msg = JSON.parse(data);
+    // سرور رخدادها را دسته‌ای و فشرده می‌فرستد: {"rows": [[ts, user, base, host, ts_int], ...]}
+    for(const r of (msg.rows || [])) pending.push({ts: r[0], user: r[1], base: r[2], host: r[3], ts_int: r[4]});
+  }catch(e){}
+}
+
+async function run(){
+  for(;;){
+    try{
+      const resp = await fetch('/api/events', {headers: {accept: 'text/event-stream'}});
+      const reader = resp.body.getReader();
+      const dec = new TextDecoder();
+      let buf = '';
+      for(;;){
+        const {value, done} = await reader.read();
+        if(done) break;
+        buf += dec.decode(value, {stream: true});
+        let i;
+        while((i = buf.indexOf('\n\n')) !== -1){
+          handleFrame(buf.slice(0, i));
+          buf = buf.slice(i + 2);
+        }
+      }
+    }catch(e){}
+    await new Promise(r => setTimeout(r, RETRY_MS));
+  }
+}
+
+setInterval(()=>{
+  if(!pending.length) return;
+  postMessage(pending);
+  pending = [];
+}, FLUSH_MS);
+run();
+"""
+
 # -----------------------------
 # API ها
 # -----------------------------
@@ -1010,10 +1982,21 @@ bootstrap();
 async def index():
     return HTMLResponse(INDEX_HTML)
 
+@app.get("/sse_worker.js")
+async def sse_worker_js():
+    return Response(SSE_WORKER_JS, media_type="application/javascript")
+
 @app.get("/api/health", response_class=PlainTextResponse)
 async def health():
     return "ok"
 
+# بدون این‌ها proxyها (مثل nginx) استریم را بافر می‌کنند
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+}
+
 @app.get("/api/events")
 async def api_events(request: Request):
     q = broadcaster.subscribe()
@@ -1025,104 +2008,119 @@ async def api_events(request: Request):
                 yield chunk
         finally:
             broadcaster.unsubscribe(q)
-    return StreamingResponse(gen(), media_type="text/event-stream")
+    return StreamingResponse(gen(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 @app.get("/api/users")
 async def api_users(
+    request: Request,
     user_q: str = Query(default=""),
     site_q: str = Query(default=""),
-    limit: int = Query(default=600, ge=1, le=5000),
+    limit: int = Query(default=USERS_DEFAULT_LIMIT, ge=1, le=5000),
 ):
     """
     Snapshot سبک از کاربران (base) بر اساس AGG در حافظه.
     جست‌وجوی نام کاربری و سایت روی نمونه hostها انجام می‌شود.
+    لیست در پس‌زمینه (_snapshot_refresher) ساخته می‌شود؛ این‌جا فقط فیلتر و انتخاب top-N.
+    پاسخ ETag دارد؛ poll دوره‌ای UI وقتی چیزی عوض نشده فقط 304 می‌گیرد.
     """
     uq = (user_q or "").strip().lower()
     sq = (site_q or "").strip().lower()
 
-    # ساخت لیست از AGG
-    items = []
-    for b, a in AGG.items():
-        display = sorted(a["variants"]) if a.get("variants") else [b]
-        hosts_set = a.get("hosts", set())
-        hosts = list(hosts_set)[:MAX_HOSTS_PER_USER]
-        prio = next((h for h in hosts if h and 'porn' in h.lower()), None)
-        sample = prio or str(a.get("sample_host", ""))
-    
-        items.append({  # ✅ همين يك append کافيست
-            "base": b,
-            "display_names": display,
-            "count": int(a.get("count", 0)),
-            "last_ts": str(a.get("last_ts", "")),
-            "sample_host": sample,
-            "hosts": hosts,
-        })
-
-
-    # فیلترها
+    # مسیر اصلی UI: همان bytes آماده‌ی snapshot، بدون هیچ کاری روی درخواست
+    if not uq and not sq and limit == USERS_DEFAULT_LIMIT:
+        return etag_response(request, SNAPSHOT_JSON, SNAPSHOT_ETAG)
+
+    # مقایسه روی فیلدهای lowercase که هنگام ورود به AGG ساخته شده‌اند
+    rows = ((it, AGG[b]) for b, it in AGG_VIEW.items())
     if uq:
-        items = [
-            it for it in items
-            if (it["base"].lower().find(uq) != -1)
-            or any((d.lower().find(uq) != -1) for d in it["display_names"])
-        ]
+        rows = (
+            (it, a) for it, a in rows
+            if uq in a["base_lc"] or any(uq in d for d in a["variants_lc"])
+        )
     if sq:
-        items = [
-            it for it in items
-            if any(((h or "").lower().find(sq) != -1) for h in it["hosts"])
-        ]
+        rows = (
+            (it, a) for it, a in rows
+            if any(sq in HOST_LC[i] for i in a["hosts"])
+        )
+    items = heapq.nlargest(limit, (it for it, _ in rows), key=itemgetter("last_ts_int"))
 
-    # مرتب‌سازی و محدودسازی
-    items.sort(key=lambda x: x.get("last_ts", ""), reverse=True)
-    return JSONResponse(items[:limit])
+    return etag_response(request, json_bytes(items))
 
 @app.get("/api/user_events")
 async def api_user_events(
     base: str,
     limit: int = Query(default=3000, ge=10, le=10000),  # ← سقف واقعی
     before_ts: Optional[str] = None,
+    offset: Optional[int] = Query(default=None, ge=0),
 ):
     try:
-        data = tail_user_events(LOG_PATH, base_user(base), limit=limit, before_ts=before_ts)
-        return JSONResponse(data)
+        rows, next_offset = tail_user_events(
+            LOG_PATH, base_user(base), limit=limit, before_ts=before_ts, offset=offset
+        )
+        return JSONBytesResponse({"rows": rows, "next_offset": next_offset})
     except FileNotFoundError:
-        return JSONResponse([], status_code=200)
+        return JSONBytesResponse({"rows": [], "next_offset": 0}, status_code=200)
+
+# فایل آمار به‌ندرت عوض می‌شود؛ JSON آماده تا وقتی (mtime, size) ثابت است دوباره استفاده می‌شود
+_STATS_KEY: Optional[Tuple[int, int]] = None
+_STATS_JSON: bytes = b"{}"
+_STATS_ETAG: str = etag_of(_STATS_JSON)
 
 @app.get("/api/stats")
-async def api_stats():
+async def api_stats(request: Request):
+    global _STATS_KEY, _STATS_JSON, _STATS_ETAG
     try:
-        if not os.path.exists(USER_STATS_FILE):
-            return JSONResponse({})
-        with open(USER_STATS_FILE, "r", encoding="utf-8") as fh:
-            data = json.load(fh)
+        st = os.stat(USER_STATS_FILE)
+    except FileNotFoundError:
+        _STATS_KEY, _STATS_JSON = None, b"{}"
+        _STATS_ETAG = etag_of(_STATS_JSON)
+        return etag_response(request, _STATS_JSON, _STATS_ETAG)
+    except OSError as e:
+        # مثلاً PermissionError یا NotADirectoryError؛ مثل خطای خواندن، آخرین نسخه‌ی سالم
+        logger.warning("Failed to stat stats file: %s", e)
+        return etag_response(request, _STATS_JSON, _STATS_ETAG)
+    key = (st.st_mtime_ns, st.st_size)
+    if key != _STATS_KEY:
+        try:
+            with open(USER_STATS_FILE, "rb") as fh:
+                raw = fh.read()
+            data = orjson.loads(raw) if orjson is not None else json.loads(raw)
             if not isinstance(data, dict):
                 data = {}
-        return JSONResponse(data)
-    except Exception as e:
-        logger.exception("Failed to read stats: %s", e)
-     
-        return JSONResponse({})
+            _STATS_JSON = json_bytes(data)
+            _STATS_ETAG = etag_of(_STATS_JSON)
+            _STATS_KEY = key
+        except Exception as e:
+            # مثلاً وسط نوشته‌شدن؛ آخرین نسخه‌ی سالم را می‌دهیم و دفعه‌ی بعد دوباره می‌خوانیم
+            logger.exception("Failed to read stats: %s", e)
+    return etag_response(request, _STATS_JSON, _STATS_ETAG)
+
 
+# پاسخ scan_progress فقط وقتی مقادیر پیشرفت عوض شوند دوباره ساخته می‌شود
+_SCAN_PROGRESS_KEY: Optional[tuple] = None
+_SCAN_PROGRESS_JSON: bytes = b""
 
 @app.get("/api/scan_progress")
 async def api_scan_progress():
+    global _SCAN_PROGRESS_KEY, _SCAN_PROGRESS_JSON
     try:
-        total = FULL_SCAN_TOTAL_BYTES or 0
-        readb = FULL_SCAN_READ_BYTES or 0
-        done  = bool(FULL_SCAN_DONE)
-        err   = FULL_SCAN_ERR
-        pct = 0.0
-        if total > 0:
-            pct = min(100.0, (readb / total) * 100.0)
-        return JSONResponse({
-            "total_bytes": total,
-            "read_bytes": readb,
-            "percent": pct,
-            "done": done,
-            "error": err
-        })
+        key = (FULL_SCAN_TOTAL_BYTES or 0, FULL_SCAN_READ_BYTES or 0, bool(FULL_SCAN_DONE), FULL_SCAN_ERR)
+        if key != _SCAN_PROGRESS_KEY:
+            total, readb, done, err = key
+            pct = 0.0
+            if total > 0:
+                pct = min(100.0, (readb / total) * 100.0)
+            _SCAN_PROGRESS_JSON = json_bytes({
+                "total_bytes": total,
+                "read_bytes": readb,
+                "percent": pct,
+                "done": done,
+                "error": err
+            })
+            _SCAN_PROGRESS_KEY = key
+        return Response(_SCAN_PROGRESS_JSON, media_type="application/json")
     except Exception:
-        return JSONResponse({"total_bytes":0,"read_bytes":0,"percent":0,"done":False,"error":"internal"}, status_code=200)
+        return JSONBytesResponse({"total_bytes":0,"read_bytes":0,"percent":0,"done":False,"error":"internal"}, status_code=200)
 
 
 
@@ -1131,8 +2129,14 @@ async def api_scan_progress():
 # -----------------------------
 @app.on_event("startup")
 async def on_start():
-    # فقط دنبال کردن خطوط جدید (بدون معطّل‌کردن UI)
-    asyncio.create_task(tail_file(LOG_PATH))
+    # بازیابی اندیس رخدادهای اخیر هر کاربر، قبل از شروع tail
+    resume = await asyncio.get_running_loop().run_in_executor(None, _load_user_tail, LOG_PATH)
+    # فقط دنبال کردن خطوط جدید (بدون معطّل‌کردن UI)؛ از همان‌جا که replay ایستاد
+    asyncio.create_task(tail_file(LOG_PATH, resume))
+    # پخش دسته‌ای رخدادهای live برای SSE
+    asyncio.create_task(_broadcaster_flusher())
+    # snapshot آماده برای /api/users
+    asyncio.create_task(_snapshot_refresher())
     # اسکن کاملِ آهسته در پس‌زمینه
     asyncio.create_task(full_scan_file(LOG_PATH))
     logger.info(f"Startup scheduled. Tailing: {LOG_PATH}; Full-scan scheduled; Stats: {USER_STATS_FILE}")
@@ -1145,13 +2149,14 @@ def main():
     parser.add_argument("--port", default=8888, type=int)
     parser.add_argument("--log-level", default="info", choices=["debug","info","warning","error"])
     parser.add_argument("--log-path", default=LOG_PATH)
+    parser.add_argument("--backlog", default=4096, type=int)
     args = parser.parse_args()
 
     LOG_PATH = args.log_path
     logger.setLevel(getattr(logging, args.log_level.upper(), logging.INFO))
 
     import uvicorn
-    uvicorn.run(app, host=args.host, port=args.port, log_level=args.log_level)
+    uvicorn.run(app, host=args.host, port=args.port, log_level=args.log_level, backlog=args.backlog)
 
 if __name__ == "__main__":
     main()